@@ -151,24 +151,23 @@ class LCD_side(config.RaspberryPi):
             if imwidth != self.height or imheight != self.width:
                 raise ValueError('Image must be same dimensions as display \
                 ({0}x{1}).' .format(self.height,self.width))
-            else:
-                img = self.np.asarray(Image)
-                pix = self.np.zeros((self.width,self.height,2), dtype = self.np.uint8)
-                pix[...,[0]] = self.np.add(self.np.bitwise_and(img[...,[0]],0xF8), self.np.right_shift(img[...,[1]],5))
-                pix[...,[1]] = self.np.add(self.np.bitwise_and(self.np.left_shift(img[...,[1]],3),0xE0), self.np.right_shift(img[...,[2]],3))
-        else:
-            img = self.np.asarray(Image)
-            pix = self.np.zeros((self.height,self.width,2), dtype = self.np.uint8)
-            pix[...,[0]] = self.np.add(self.np.bitwise_and(img[...,[0]],0xF8), self.np.right_shift(img[...,[1]],5))
-            pix[...,[1]] = self.np.add(self.np.bitwise_and(self.np.left_shift(img[...,[1]],3),0xE0), self.np.right_shift(img[...,[2]],3))
-
-        pix = pix.flatten().tolist()
+        self.ShowArray(self.np.asarray(Image))
+
+    def ShowArray(self, img):
+        """Write an RGB NumPy array of the display size (either orientation), converted in a reused buffer"""
+        pix = self.to_rgb565(img)
         self.SetWindows ( 0, 0, self.width, self.height)
         self.digital_write(self.GPIO_DC_PIN,True)
+        self.spi_writebuffer(pix)
 
-        for i in range(0,len(pix),4096):#The length is 160*160*2 Actually 160*80*2 So take 2
-            self.spi_writebyte(pix[i:i+4096])
 
+    def ShowRows(self, rows, Ystart):
+        """Write a band of full-width RGB rows (NumPy array) starting at display row Ystart"""
+        height = rows.shape[0]
+        pix = self.to_rgb565(rows)
+        self.SetWindows ( 0, Ystart, self.width, Ystart + height)
+        self.digital_write(self.GPIO_DC_PIN,True)
+        self.spi_writebuffer(pix)
 
     def clear(self):
         """Clear contents of image buffer"""
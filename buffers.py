@@ -0,0 +1,155 @@
+import functools
+import logging
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+LARGE_ALLOCATION = 64 * 1024  # Bytes, anything frame- or image-sized
+
+
+class BufferPool:
+    """Per-frame arrays, allocated once per name and geometry and then reused.
+
+    get() returns the same array for as long as the shape and dtype stay
+    the same, so the live loop fills it through out= parameters and in-place
+    operations. A new geometry, e.g. another capture mode, replaces it.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+        self.allocations = 0
+
+    def get(self, name, shape, dtype=np.uint8):
+        shape = tuple(shape)
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = self._buffers[name] = np.empty(shape, dtype=dtype)
+            self.allocations += 1
+        return buffer
+
+
+def capture_frame(picam2, pool, name='frame', stream='main', with_metadata=False):
+    """Copy the next frame of `stream` straight into a pooled buffer.
+
+    capture_array() returns a new array every frame. Here the request buffer
+    is mapped and copied into the pool buffer instead, then released. With
+    `with_metadata` the frame's metadata is returned too, as (frame, metadata).
+    """
+    size = picam2.camera_configuration()[stream]['size']
+    request = picam2.capture_request()
+    try:
+        frame = copy_stream(request, pool, name, size, stream)
+        metadata = request.get_metadata() if with_metadata else None
+    finally:
+        request.release()
+    return (frame, metadata) if with_metadata else frame
+
+
+def copy_stream(request, pool, name, size, stream='main'):
+    """Copy one stream of a captured request into a pooled buffer, without the row padding."""
+    from picamera2 import MappedArray  # Deferred like the Picamera2 import in init_camera
+    width, height = size
+    with MappedArray(request, stream) as mapped:
+        source = mapped.array[:height, :width]
+        frame = pool.get(name, source.shape, source.dtype)
+        np.copyto(frame, source)
+    return frame
+
+
+@functools.lru_cache(maxsize=8)
+def preview_map(height, width, size, rotate=0, marks=()):
+    """Where each preview pixel comes from in a (height, width) frame.
+
+    The preview is what Image.rotate(rotate) followed by a nearest-neighbour
+    resize to `size` (rows, columns) would show. It is worked out once by
+    putting an image of pixel indices through PIL itself. Returns the flat
+    source index of every preview pixel, the flat preview positions left
+    empty by the rotation and those showing the source columns in `marks`.
+    """
+    index = np.arange(1, height * width + 1, dtype=np.int32).reshape(height, width)
+    image = Image.fromarray(index, 'I').rotate(rotate, resample=Image.NEAREST).resize(size[::-1], Image.NEAREST)
+    indices = np.asarray(image, dtype=np.intp) - 1
+    outside = indices < 0
+    source_cols = np.where(outside, -1, indices % width)
+    sampled = np.unique(source_cols[~outside])
+    marked = np.zeros(indices.shape, dtype=bool)
+    for mark in marks:
+        # The sampled column closest to the mark stands in for it
+        if len(sampled):
+            marked |= source_cols == sampled[np.argmin(np.abs(sampled - mark))]
+    indices[outside] = 0  # Left writable, np.take copies read-only index arrays
+    return indices, np.flatnonzero(outside), np.flatnonzero(marked)
+
+
+def draw_preview(frame, out, rotate=0, marks=(), mark_color=(255, 0, 0)):
+    """Sample a contiguous (H, W, 3) frame into `out`, marking the given source columns."""
+    indices, outside, marked = preview_map(frame.shape[0], frame.shape[1], out.shape[:2], rotate, tuple(marks))
+    np.take(frame.reshape(-1, frame.shape[2]), indices, axis=0, out=out, mode='clip')
+    pixels = out.reshape(-1, out.shape[2])
+    pixels[outside] = 0
+    pixels[marked] = mark_color
+    return out
+
+
+class AllocationCheck:
+    """Measure how much memory each loop iteration allocates, using tracemalloc.
+
+    Armed with start(), it traces a few warm-up frames and then `frames`
+    more. For each one it records the peak of traced memory above the level
+    at the start of the frame, which catches temporaries that are freed
+    again before the frame ends. A steady-state loop should stay below
+    `threshold` on every frame. frame() is a no-op while not armed, so it can
+    stay in the loop.
+    """
+
+    def __init__(self, threshold=LARGE_ALLOCATION):
+        self.threshold = threshold
+        self.report = None
+        self._warmup = 0
+        self._remaining = 0
+        self._peaks = []
+        self._baseline = 0
+        self._first = 0
+
+    def start(self, frames=20, warmup=3):
+        self._warmup = warmup
+        self._remaining = frames
+        self._peaks = []
+        self._first = 0
+        self.report = {'status': 'running'}
+
+    def frame(self):
+        """Call once at the top of every loop iteration."""
+        if not self._remaining:
+            return
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        else:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._warmup:
+                self._warmup -= 1
+                self._first = current
+            else:
+                self._peaks.append(peak - self._baseline)
+                self._remaining -= 1
+                if not self._remaining:
+                    self._finish(current)
+                    return
+        self._baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+    def _finish(self, current):
+        tracemalloc.stop()
+        peaks = np.array(self._peaks)
+        self.report = {
+            'status': 'done',
+            'frames': len(peaks),
+            'threshold': self.threshold,
+            'max_peak': int(peaks.max()),
+            'mean_peak': float(peaks.mean()),
+            'large_frames': int(np.sum(peaks >= self.threshold)),
+            'growth': int(current - self._first),  # Memory kept across the measured frames
+            'ok': bool(peaks.max() < self.threshold),
+        }
+        logging.info(f"Allocation check: {self.report}")
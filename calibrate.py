@@ -0,0 +1,161 @@
+import itertools
+import json
+import logging
+import os
+from datetime import datetime
+
+import numpy as np
+
+# Strong lines of a fluorescent (mercury + rare-earth phosphor) lamp in nm
+FLUORESCENT_LINES = [404.66, 435.83, 487.70, 542.40, 546.07, 577.00, 587.60, 611.60, 631.10]
+
+
+def detect_peaks(spectrum, distance=8, max_peaks=12, min_height=0.1):
+    """Strongest local maxima with sub-pixel positions from a parabola through each top."""
+    spectrum = np.asarray(spectrum, dtype=np.float64)
+    spectrum = spectrum - np.min(spectrum)
+    if np.max(spectrum) <= 0:
+        return np.empty(0), np.empty(0)
+    spectrum /= np.max(spectrum)
+    windows = np.lib.stride_tricks.sliding_window_view(np.pad(spectrum, distance, mode='edge'), 2 * distance + 1)
+    is_peak = (spectrum == windows.max(axis=1)) & (spectrum > min_height)
+    is_peak[[0, -1]] = False
+    idx = np.flatnonzero(is_peak)
+    idx = idx[np.argsort(spectrum[idx])[::-1][:max_peaks]]
+    left, centre, right = spectrum[idx - 1], spectrum[idx], spectrum[idx + 1]
+    denom = left - 2 * centre + right
+    offset = np.divide(0.5 * (left - right), denom, out=np.zeros_like(denom), where=denom != 0)
+    order = np.argsort(idx)
+    return (idx + np.clip(offset, -0.5, 0.5))[order], centre[order]
+
+
+def _candidate_models(pixels, lines):
+    """Quadratics through every order-preserving triple of (peak, line) pairs.
+
+    Peaks and lines are both sorted, and the dispersion may run either way,
+    so each peak triple is paired with each line triple forwards and reversed.
+    All exact fits are solved in one batched call.
+    """
+    peak_triples = np.array(list(itertools.combinations(range(len(pixels)), 3)))
+    line_triples = np.array(list(itertools.combinations(range(len(lines)), 3)))
+    line_triples = np.concatenate([line_triples, line_triples[:, ::-1]])
+    p = np.repeat(peak_triples, len(line_triples), axis=0)
+    l = np.tile(line_triples, (len(peak_triples), 1))
+    x = pixels[p]
+    y = lines[l]
+    vander = np.stack([x ** 2, x, np.ones_like(x)], axis=-1)
+    solvable = np.abs(np.linalg.det(vander)) > 1e-9
+    return np.linalg.solve(vander[solvable], y[solvable][..., None])[..., 0]
+
+
+def fit_calibration(pixels, lines, length, weights=None, tolerance=1.5, min_lines=4, max_rms=1.0):
+    """RANSAC-style line assignment and a validated second-degree fit.
+
+    Every candidate model predicts a wavelength for every peak. A peak
+    counts as an inlier if it lands within `tolerance` nm of a known line.
+    Inliers are weighted by peak height so strong lines outvote noise. The
+    best model (then the lowest error) is refitted on its inliers. It must
+    be monotonic over the sensor, match at least `min_lines` lines and have
+    an RMS residual below `max_rms` nm.
+    Returns (poly1d, report), or (None, report) when validation fails.
+    """
+    pixels = np.asarray(pixels, dtype=np.float64)
+    weights = np.ones_like(pixels) if weights is None else np.asarray(weights, dtype=np.float64)
+    lines = np.sort(np.asarray(lines, dtype=np.float64))
+    if len(pixels) < 3:
+        return None, {'error': 'fewer than 3 peaks found'}
+
+    models = _candidate_models(pixels, lines)
+    # Reject models that fold back on themselves within the sensor
+    ends = np.array([0.0, length - 1.0])
+    slopes = 2 * models[:, :1] * ends + models[:, 1:2]
+    models = models[np.sign(slopes[:, 0]) == np.sign(slopes[:, 1])]
+    if not len(models):
+        return None, {'error': 'no monotonic model found'}
+
+    predicted = models[:, :1] * pixels ** 2 + models[:, 1:2] * pixels + models[:, 2:3]
+    errors = np.min(np.abs(predicted[..., None] - lines), axis=-1)
+    inliers = errors < tolerance
+    score = (inliers * weights).sum(axis=1)
+    cost = np.where(inliers, errors, 0).sum(axis=1)
+    best = np.lexsort((cost, -score))[0]
+
+    # Pair each inlier peak with its nearest line, each line used once
+    nearest = np.argmin(np.abs(predicted[best][:, None] - lines), axis=1)
+    pairs = {}
+    for i in np.flatnonzero(inliers[best]):
+        j = nearest[i]
+        if j not in pairs or errors[best, i] < errors[best, pairs[j]]:
+            pairs[j] = i
+    matched_lines = np.array(sorted(pairs))
+    matched_pixels = pixels[[pairs[j] for j in matched_lines]]
+    matched_lines = lines[matched_lines]
+
+    report = {'matched': [[float(p), float(w)] for p, w in zip(matched_pixels, matched_lines)]}
+    if len(matched_lines) < min_lines:
+        report['error'] = f'only {len(matched_lines)} lines matched'
+        return None, report
+
+    polynomial = np.poly1d(np.polyfit(matched_pixels, matched_lines, 2))
+    residuals = matched_lines - polynomial(matched_pixels)
+    rms = float(np.sqrt(np.mean(residuals ** 2)))
+    report.update({
+        'residuals': residuals.tolist(),
+        'rms': rms,
+        'max_residual': float(np.max(np.abs(residuals))),
+    })
+    derivative = polynomial.deriv()(np.arange(length))
+    if not (np.all(derivative > 0) or np.all(derivative < 0)):
+        report['error'] = 'fit is not monotonic'
+        return None, report
+    if rms > max_rms:
+        report['error'] = f'RMS residual {rms:.2f} nm too large'
+        return None, report
+    return polynomial, report
+
+
+def calibrate_from_spectrum(spectrum, lines=FLUORESCENT_LINES, **kwargs):
+    pixels, heights = detect_peaks(spectrum)
+    polynomial, report = fit_calibration(pixels, lines, len(spectrum), heights, **kwargs)
+    report['peaks'] = pixels.tolist()
+    return polynomial, report
+
+
+def save_calibration(path, polynomial, report, length):
+    data = dict(report)
+    data.update({
+        'coefficients': polynomial.coeffs.tolist(),
+        'length': length,
+        'created': datetime.now().isoformat(),
+    })
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, path)
+
+
+def load_calibration(path):
+    """Return the saved (polynomial, length), or None if there is none.
+
+    length is the number of spectrum points the polynomial was fit on, None
+    for files written before it was recorded.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            data = json.load(f)
+        logging.info(f"Loaded calibration from {data.get('created')}, RMS {data.get('rms', 0):.3f} nm")
+        return np.poly1d(data['coefficients']), data.get('length')
+    except (ValueError, KeyError) as e:
+        logging.warning(f"Ignoring bad calibration file {path}: {e}")
+        return None
+
+
+def rescale(polynomial, length, new_length):
+    """Polynomial for spectra of `new_length` points spanning the same rows as the `length` it was fit on."""
+    if not length or not new_length or length == new_length:
+        return polynomial
+    # The centre of point i lies at (i + 0.5) * length / new_length - 0.5 on the calibrated axis
+    scale = length / new_length
+    return polynomial(np.poly1d([scale, 0.5 * scale - 0.5]))
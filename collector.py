@@ -0,0 +1,291 @@
+"""Collect spectra from many Spectrometer Zero units into one combined view.
+
+Every unit already records its spectra in its /history ring. The collector
+polls each unit for the records added since the last poll, in npz pages of
+a bounded number of rows over one kept-alive HTTP connection per unit. It resamples
+them onto a common wavelength grid and serves combined and per-unit
+queries.
+
+    python collector.py 192.168.1.20:5000 192.168.1.21:5000
+    python collector.py --demo 12      # against local stand-in units
+"""
+import argparse
+import http.client
+import io
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from flask import Flask, abort, jsonify, request, send_file
+from werkzeug.serving import WSGIRequestHandler
+
+logging.basicConfig(level=logging.INFO)
+
+
+def resample_weights(source_axis, grid):
+    """Index and weight arrays that linearly resample any batch from source_axis onto grid."""
+    order = np.argsort(source_axis)
+    axis = np.asarray(source_axis, dtype=np.float64)[order]
+    idx = np.clip(np.searchsorted(axis, grid) - 1, 0, len(axis) - 2)
+    span = axis[idx + 1] - axis[idx]
+    weight = np.clip(np.divide(grid - axis[idx], span, out=np.zeros_like(grid), where=span != 0), 0, 1)
+    outside = (grid < axis[0]) | (grid > axis[-1])
+    return order[idx], order[idx + 1], weight, outside
+
+
+# Resample a (T, N) batch in one vectorized step using precomputed weights
+def resample(spectra, weights):
+    lo, hi, weight, outside = weights
+    out = spectra[:, lo] * (1 - weight) + spectra[:, hi] * weight
+    out[:, outside] = np.nan
+    return out.astype(np.float32)
+
+
+class Unit:
+    """One remote spectrometer: its connection, poll state and recent records."""
+
+    def __init__(self, address, grid, capacity=3600, backfill=60.0, timeout=5.0, page_rows=500, max_pages=8):
+        self.address = address
+        host, _, port = address.partition(':')
+        self.host, self.port = host, int(port or 5000)
+        self.grid = grid
+        self.timeout = timeout
+        self.page_rows = page_rows
+        self.max_pages = max_pages  # A unit far behind catches up over several polls
+        self.last_timestamp = time.time() - backfill
+        self.last_poll = None
+        self.error = None
+        self.timestamps = np.full(capacity, np.nan)
+        self.spectra = np.full((capacity, len(grid)), np.nan, dtype=np.float32)
+        self.head = 0
+        self.count = 0
+        self._weights = None
+        self._axis = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _get(self, path):
+        # One persistent connection per unit, reopened after any failure
+        for attempt in range(2):
+            if self._conn is None:
+                self._conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self._conn.request('GET', path, headers={'Connection': 'keep-alive'})
+                response = self._conn.getresponse()
+                return response.status, response.read(), response.getheader('X-History-Next')
+            except (OSError, http.client.HTTPException):
+                self._conn.close()
+                self._conn = None
+                if attempt:
+                    raise
+
+    def poll(self):
+        added = 0
+        try:
+            # Every row is wanted, in pages of page_rows; the unit names the start of the next page
+            start = repr(self.last_timestamp)
+            for _ in range(self.max_pages):
+                status, body, following = self._get(
+                    f'/history?format=npz&decimate=1&limit={self.page_rows}&from={start}')
+                if status == 503:
+                    self.error = 'no data yet'
+                    return added
+                if status != 200:
+                    raise RuntimeError(f'HTTP {status}')
+                batch = np.load(io.BytesIO(body))
+                timestamps = batch['timestamps']
+                fresh = timestamps > self.last_timestamp
+                added += self._store(batch['wavelengths'], timestamps[fresh], batch['spectra'][fresh])
+                if following is None:
+                    break
+                start = following
+            self.error = None
+            return added
+        except Exception as e:
+            self.error = str(e)
+            return added
+        finally:
+            self.last_poll = time.time()
+
+    def _store(self, axis, timestamps, spectra):
+        if not len(timestamps):
+            return 0
+        if self._axis is None or not np.array_equal(axis, self._axis):
+            self._axis = axis
+            self._weights = resample_weights(axis, self.grid)
+        aligned = resample(np.asarray(spectra, dtype=np.float64), self._weights)
+        capacity = len(self.timestamps)
+        with self._lock:
+            slots = (self.head + np.arange(len(timestamps))) % capacity
+            self.timestamps[slots] = timestamps
+            self.spectra[slots] = aligned
+            self.head = (self.head + len(timestamps)) % capacity
+            self.count = min(self.count + len(timestamps), capacity)
+        self.last_timestamp = float(timestamps[-1])
+        return len(timestamps)
+
+    def select(self, start, end):
+        with self._lock:
+            mask = (self.timestamps >= start) & (self.timestamps <= end)
+            order = np.argsort(self.timestamps[mask])
+            return self.timestamps[mask][order], self.spectra[mask][order]
+
+    def status(self):
+        return {
+            'address': self.address,
+            'records': self.count,
+            'last_timestamp': self.last_timestamp,
+            'last_poll': self.last_poll,
+            'error': self.error,
+        }
+
+
+class Collector:
+    def __init__(self, addresses, grid, interval=2.0, workers=16):
+        self.grid = grid
+        self.interval = interval
+        self.units = {address: Unit(address, grid) for address in addresses}
+        self._pool = ThreadPoolExecutor(max_workers=min(workers, max(1, len(addresses))))
+
+    def run(self):
+        while True:
+            started = time.time()
+            added = sum(self._pool.map(lambda unit: unit.poll(), self.units.values()))
+            logging.debug(f"Polled {len(self.units)} units, {added} new spectra in {time.time() - started:.2f}s")
+            time.sleep(max(0.0, self.interval - (time.time() - started)))
+
+    def binned(self, start, end, bin_seconds, addresses):
+        """Mean spectrum per unit per time bin, shaped (units, bins, grid)."""
+        edges = np.arange(start, end + bin_seconds, bin_seconds)
+        result = np.full((len(addresses), len(edges) - 1, len(self.grid)), np.nan, dtype=np.float32)
+        for u, address in enumerate(addresses):
+            timestamps, spectra = self.units[address].select(start, end)
+            if not len(timestamps):
+                continue
+            bins = np.clip(np.digitize(timestamps, edges) - 1, 0, len(edges) - 2)
+            sums = np.zeros((len(edges) - 1, len(self.grid)))
+            np.add.at(sums, bins, np.nan_to_num(spectra))
+            counts = np.bincount(bins, minlength=len(edges) - 1)[:, None]
+            np.divide(sums, counts, out=result[u], where=counts > 0)
+        return edges[:-1], result
+
+
+def create_app(collector):
+    app = Flask(__name__)
+
+    def selected_units():
+        names = request.args.get('units')
+        addresses = names.split(',') if names else list(collector.units)
+        if any(address not in collector.units for address in addresses):
+            abort(404)
+        return addresses
+
+    @app.route('/units')
+    def units():
+        return jsonify([unit.status() for unit in collector.units.values()])
+
+    @app.route('/combined')
+    def combined():
+        # Latest spectrum of every unit on the common grid
+        latest = {}
+        for address in selected_units():
+            unit = collector.units[address]
+            timestamps, spectra = unit.select(unit.last_timestamp, unit.last_timestamp)
+            if len(timestamps):
+                latest[address] = {'timestamp': float(timestamps[-1]),
+                                   'spectrum': np.nan_to_num(spectra[-1]).tolist()}
+        return jsonify({'wavelengths': collector.grid.tolist(), 'units': latest})
+
+    @app.route('/query')
+    def query():
+        now = time.time()
+        start = request.args.get('from', now - 60, type=float)
+        end = request.args.get('to', now, type=float)
+        bin_seconds = max(0.1, request.args.get('bin', 1.0, type=float))
+        if (end - start) / bin_seconds > 100000:
+            abort(400)  # Too many bins for one request
+        addresses = selected_units()
+        times, spectra = collector.binned(start, end, bin_seconds, addresses)
+        if request.args.get('format') == 'npz':
+            buffer = io.BytesIO()
+            np.savez_compressed(buffer, wavelengths=collector.grid, timestamps=times,
+                                units=np.array(addresses), spectra=spectra)
+            buffer.seek(0)
+            return send_file(buffer, mimetype='application/octet-stream', download_name='combined.npz')
+        return jsonify({
+            'wavelengths': collector.grid.tolist(),
+            'timestamps': times.tolist(),
+            'units': addresses,
+            'spectra': np.where(np.isnan(spectra), None, spectra).tolist(),
+        })
+
+    return app
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Lets the stand-in units keep connections open like a pooled client expects
+
+
+def start_stand_in_units(count, first_port=5100, rate=5.0):
+    """Serve synthetic /history endpoints on local ports, like real units would."""
+    addresses = []
+    for n in range(count):
+        app = Flask(f'unit{n}')
+        axis = np.linspace(700, 380, 1080)
+        peak = 450 + 200 * n / max(1, count - 1)
+        started = time.time()
+
+        def history(axis=axis, peak=peak, started=started):
+            end = time.time()
+            start = max(request.args.get('from', started, type=float), end - 60)
+            timestamps = np.arange(np.ceil(start * rate) / rate, end, 1 / rate)
+            timestamps = timestamps[timestamps > start]
+            limit = request.args.get('limit', type=int)
+            headers = {}
+            if limit and len(timestamps) > limit:
+                timestamps = timestamps[:limit]
+                headers['X-History-Next'] = repr(float(np.nextafter(timestamps[-1], np.inf)))
+            drift = 5 * np.sin(timestamps / 30)[:, None]
+            spectra = 1000 * np.exp(-0.5 * ((axis[None, :] - peak - drift) / 8) ** 2)
+            buffer = io.BytesIO()
+            np.savez_compressed(buffer, wavelengths=axis, timestamps=timestamps, spectra=spectra.astype(np.float32))
+            buffer.seek(0)
+            response = send_file(buffer, mimetype='application/octet-stream')
+            response.headers.update(headers)
+            return response
+
+        app.add_url_rule('/history', 'history', history)
+        port = first_port + n
+        threading.Thread(target=app.run, kwargs={'host': '127.0.0.1', 'port': port, 'threaded': True,
+                                                         'request_handler': KeepAliveHandler},
+                         daemon=True).start()
+        addresses.append(f'127.0.0.1:{port}')
+    return addresses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('units', nargs='*', help='host:port of each unit')
+    parser.add_argument('--demo', type=int, default=0, help='start this many local stand-in units')
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between polls')
+    parser.add_argument('--grid', default='380,780,1', help='common wavelength grid start,stop,step in nm')
+    parser.add_argument('--port', type=int, default=5050)
+    args = parser.parse_args()
+
+    addresses = list(args.units)
+    if args.demo:
+        addresses += start_stand_in_units(args.demo)
+        time.sleep(1)  # Let the stand-in servers bind their ports
+    if not addresses:
+        parser.error('no units given')
+
+    low, high, step = (float(v) for v in args.grid.split(','))
+    collector = Collector(addresses, np.arange(low, high + step / 2, step), interval=args.interval)
+    threading.Thread(target=collector.run, daemon=True).start()
+    create_app(collector).run(host='0.0.0.0', port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
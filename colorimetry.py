@@ -0,0 +1,87 @@
+import numpy as np
+
+
+# Piecewise Gaussian used by the multi-lobe CIE 1931 fit of Wyman, Sloan and Shirley (2013)
+def _lobe(wavelengths, mean, sigma_left, sigma_right):
+    sigma = np.where(wavelengths < mean, sigma_left, sigma_right)
+    return np.exp(-0.5 * ((wavelengths - mean) / sigma) ** 2)
+
+
+def cie1931(wavelengths):
+    """CIE 1931 2-degree colour matching functions as a (3, N) array."""
+    wl = np.asarray(wavelengths, dtype=np.float64)
+    x = 1.056 * _lobe(wl, 599.8, 37.9, 31.0) + 0.362 * _lobe(wl, 442.0, 16.0, 26.7) \
+        - 0.065 * _lobe(wl, 501.1, 20.4, 26.2)
+    y = 0.821 * _lobe(wl, 568.8, 46.9, 40.5) + 0.286 * _lobe(wl, 530.9, 16.3, 31.1)
+    z = 1.217 * _lobe(wl, 437.0, 11.8, 36.0) + 0.681 * _lobe(wl, 459.0, 26.0, 13.8)
+    return np.stack([x, y, z])
+
+
+# CIE 1960 (u, v) from XYZ, works on (..., 3) arrays
+def xyz_to_uv(xyz):
+    X, Y, Z = np.moveaxis(np.asarray(xyz, dtype=np.float64), -1, 0)
+    denom = X + 15 * Y + 3 * Z
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.stack([4 * X / denom, 6 * Y / denom], axis=-1)
+
+
+def planckian_locus(temperatures):
+    """(u, v) of black bodies at `temperatures`, integrated on a 1 nm grid."""
+    wl = np.arange(360.0, 831.0)
+    wl_m = wl[None, :] * 1e-9
+    t = np.asarray(temperatures, dtype=np.float64)[:, None]
+    # Planck's law, constant factors cancel in chromaticity
+    radiance = 1 / (wl_m ** 5 * np.expm1(1.4388e-2 / (wl_m * t)))
+    return xyz_to_uv(radiance @ cie1931(wl).T)
+
+
+class Colorimeter:
+    """XYZ, chromaticity, CCT and Duv of a spectrum on the device axis.
+
+    The colour matching functions are resampled onto the wavelength axis
+    once, with the bin widths folded in, as a (3, N) matrix. Each frame is
+    then one matrix-vector product. CCT and Duv come from the nearest point
+    on a precomputed Planckian locus, refined with a parabola through its
+    neighbours.
+    """
+
+    def __init__(self, t_min=1000, t_max=25000, steps=600):
+        # Even steps in mired are even steps in perceived colour
+        self.temperatures = 1e6 / np.linspace(1e6 / t_min, 1e6 / t_max, steps)
+        self.locus = planckian_locus(self.temperatures)
+        self.matrix = None
+        self._axis_key = None
+
+    def ensure(self, axis):
+        axis = np.asarray(axis, dtype=np.float64)
+        axis_key = (len(axis), hash(axis.tobytes()))
+        if axis_key != self._axis_key:
+            self._axis_key = axis_key
+            widths = np.abs(np.gradient(axis)) if len(axis) > 1 else np.ones(1)
+            self.matrix = cie1931(axis) * widths
+
+    def measure(self, spectrum):
+        X, Y, Z = self.matrix @ np.asarray(spectrum, dtype=np.float64)
+        total = X + Y + Z
+        if total <= 0:
+            return None
+        uv = xyz_to_uv(np.array([X, Y, Z]))
+        distances = np.hypot(*(self.locus - uv).T)
+        i = int(np.clip(np.argmin(distances), 1, len(distances) - 2))
+        # Parabola through the three nearest locus points for a smooth CCT
+        d0, d1, d2 = distances[i - 1:i + 2]
+        denom = d0 - 2 * d1 + d2
+        offset = 0.5 * (d0 - d2) / denom if denom > 0 else 0.0
+        offset = float(np.clip(offset, -1, 1))
+        mired = np.interp(i + offset, np.arange(len(self.temperatures)), 1e6 / self.temperatures)
+        duv = d1 - 0.25 * (d0 - d2) * offset
+        # Above the locus (greener) is positive Duv
+        if uv[1] < self.locus[i, 1]:
+            duv = -duv
+        return {
+            'X': float(X), 'Y': float(Y), 'Z': float(Z),
+            'x': float(X / total), 'y': float(Y / total),
+            'u': float(uv[0]), 'v': float(uv[1]),
+            'cct': float(1e6 / mired),
+            'duv': float(duv),
+        }
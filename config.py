@@ -48,8 +48,14 @@ KEY2_PIN       = 20
 KEY3_PIN       = 16
 
 class RaspberryPi:
-    def __init__(self,spi=spidev.SpiDev(0,0),spi_freq=40000000,rst = 27,dc = 25,bl = 24,bl_freq=1000,i2c=None,i2c_freq=100000):
+    def __init__(self,spi=None,spi_freq=40000000,rst = 27,dc = 25,bl = 24,bl_freq=1000,i2c=None,i2c_freq=100000):
+        # Open the default bus here rather than as a default argument, which ran at import time
+        if spi is None:
+            spi = spidev.SpiDev(0,0)
         self.np=np
+        # RGB565 output and scratch space, grown on demand and reused for every write
+        self._rgb565 = np.empty(0, dtype=np.uint8)
+        self._rgb565_scratch = np.empty(0, dtype=np.uint8)
         self.INPUT = False
         self.OUTPUT = True
 
@@ -107,6 +113,35 @@ class RaspberryPi:
         if self.SPI!=None :
             self.SPI.writebytes(data)
 
+    def spi_writebuffer(self, data):
+        """Write a contiguous uint8 NumPy array without building a Python list"""
+        if self.SPI!=None :
+            if hasattr(self.SPI, 'writebytes2'):
+                self.SPI.writebytes2(data)
+            else:
+                data = data.ravel().tolist()
+                for i in range(0,len(data),4096):
+                    self.SPI.writebytes(data[i:i+4096])
+
+    def to_rgb565(self, img):
+        """Convert an (H, W, 3) RGB array to big-endian RGB565 in a reused (H, W, 2) buffer"""
+        height, width = img.shape[:2]
+        count = height * width
+        if self._rgb565.size < count * 2:
+            self._rgb565 = np.empty(count * 2, dtype=np.uint8)
+            self._rgb565_scratch = np.empty(count, dtype=np.uint8)
+        pix = self._rgb565[:count * 2].reshape(height, width, 2)
+        tmp = self._rgb565_scratch[:count].reshape(height, width)
+        high, low = pix[...,0], pix[...,1]
+        np.bitwise_and(img[...,0], 0xF8, out=high)
+        np.right_shift(img[...,1], 5, out=tmp)
+        np.bitwise_or(high, tmp, out=high)
+        np.left_shift(img[...,1], 3, out=tmp)
+        np.bitwise_and(tmp, 0xE0, out=low)
+        np.right_shift(img[...,2], 3, out=tmp)
+        np.bitwise_or(low, tmp, out=low)
+        return pix
+
     def bl_DutyCycle(self, duty):
         self.GPIO_BL_PIN.value = duty / 100
 
@@ -0,0 +1,143 @@
+import collections
+import glob
+import logging
+import os
+
+import numpy as np
+
+
+# Mean of the reduced spectra of `count` frames from `capture`, accumulated so no frames are kept
+def average_spectra(capture, process, count=16):
+    total = None
+    for _ in range(count):
+        spectra, _ = process(capture())
+        if total is None:
+            total = np.zeros(spectra.shape)
+        total += spectra
+    return total / count
+
+
+class Calibration:
+    """Dark level and flat-field gain of one exposure/gain setting, on the spectral axis.
+
+    Both are (H, 3) like the spectra process_frame returns, so a frame is
+    corrected on its reduced spectrum rather than on the full image:
+    (spectra - dark) * gain, folded into spectra * gain - dark * gain.
+    """
+
+    def __init__(self, dark=None, gain=None):
+        self.dark = dark
+        self.gain = gain
+        self._update()
+
+    def _update(self):
+        dark, gain = self.dark, self.gain
+        if gain is None and dark is not None:
+            gain = np.ones(dark.shape)
+        self._gain = gain
+        self._offset = dark * gain if dark is not None else None
+
+    def set_dark(self, dark):
+        self.dark = dark
+        self._update()
+
+    def set_flat(self, flat):
+        """Derive the gain from an averaged flat field, with the dark level already subtracted if known."""
+        response = flat - self.dark if self.dark is not None else np.array(flat, dtype=np.float64)
+        # Scale every pixel to the mean response of its channel, dead pixels are left as they are
+        mean = np.mean(response, axis=0)
+        self.gain = np.divide(mean, response, out=np.ones(response.shape), where=response > mean * 0.05)
+        self._update()
+
+    def terms(self):
+        """(gain, offset) with corrected = spectra * gain - offset, or None before anything was captured."""
+        if self._gain is None:
+            return None
+        return self._gain, self._offset if self._offset is not None else np.zeros(self._gain.shape)
+
+    def apply(self, spectra, out=None):
+        """Corrected copy of `spectra`, written into `out` when given, or None when the geometry differs."""
+        gain = self._gain
+        if gain is None or gain.shape != spectra.shape:
+            return None
+        out = np.multiply(spectra, gain, out=out)
+        if self._offset is not None:
+            out -= self._offset
+        np.maximum(out, 0, out=out)  # Noise below the dark level is not negative light
+        return out
+
+
+class CorrectionStore:
+    """Calibrations keyed by (exposure, gain), the most recently used kept in memory.
+
+    Each calibration is also saved as an npz file in `directory`, so a
+    setting that fell out of the cache, or was captured in an earlier
+    session, is loaded again on first use.
+    """
+
+    def __init__(self, directory='corrections', maxsize=8):
+        self.directory = directory
+        self.maxsize = maxsize
+        self._cache = collections.OrderedDict()
+        self._missing = set()  # Settings known to have no file, so lookups stay cheap
+
+    def _path(self, key):
+        exposure, gain = key
+        return os.path.join(self.directory, f"{int(exposure)}us_{float(gain):g}x.npz")
+
+    def _load(self, key):
+        with np.load(self._path(key)) as data:
+            return Calibration(data['dark'] if 'dark' in data else None,
+                               data['gain'] if 'gain' in data else None)
+
+    def _remember(self, key, calibration):
+        self._cache[key] = calibration
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def get(self, exposure, gain):
+        key = (int(exposure), float(gain))
+        calibration = self._cache.get(key)
+        if calibration is not None:
+            self._cache.move_to_end(key)
+            return calibration
+        if key in self._missing:
+            return None
+        try:
+            calibration = self._load(key)
+        except FileNotFoundError:
+            self._missing.add(key)
+            return None
+        except Exception as e:
+            logging.warning(f"Skipping correction file {self._path(key)}: {e}")
+            self._missing.add(key)
+            return None
+        self._remember(key, calibration)
+        return calibration
+
+    def _update(self, exposure, gain, change):
+        key = (int(exposure), float(gain))
+        calibration = self.get(*key) or Calibration()
+        change(calibration)
+        os.makedirs(self.directory, exist_ok=True)
+        arrays = {name: value for name, value in (('dark', calibration.dark), ('gain', calibration.gain))
+                  if value is not None}
+        np.savez(self._path(key), **arrays)
+        self._missing.discard(key)
+        self._remember(key, calibration)
+        return calibration
+
+    def set_dark(self, exposure, gain, dark):
+        return self._update(exposure, gain, lambda c: c.set_dark(dark))
+
+    def set_flat(self, exposure, gain, flat):
+        return self._update(exposure, gain, lambda c: c.set_flat(flat))
+
+    def settings(self):
+        """(exposure, gain) of every calibration on disk."""
+        keys = []
+        for path in sorted(glob.glob(os.path.join(self.directory, '*us_*x.npz'))):
+            exposure, _, gain = os.path.basename(path)[:-len('x.npz')].partition('us_')
+            keys.append((int(exposure), float(gain)))
+        return keys
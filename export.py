@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import queue
+import tarfile
+import threading
+import time
+
+import numpy as np
+
+INDEX_NAME = 'index.json'
+
+
+# Write a file next to its destination and move it into place, so readers never see half a file
+def _atomic_write(path, write):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+# Compress and write one chunk, module level so it can run in a worker process
+def write_npz(path, **arrays):
+    _atomic_write(path, lambda f: np.savez_compressed(f, **arrays))
+
+
+class SpectrumExporter:
+    """Write spectra (and optionally frames) into compressed .npz chunks.
+
+    Rows are buffered until `chunk_size` of them are collected, then the chunk
+    is compressed and written by a background thread so the live loop never
+    waits on zlib or the SD card. `index.json` in the same directory lists
+    every chunk with its time range and holds the session metadata. With an
+    offload.OffloadPool the compression itself runs in a worker process.
+
+    At most `max_queued` chunks wait for the writer, which bounds the memory
+    held to about (max_queued + 1) * chunk_size rows. When the writer falls
+    behind, add() blocks, or with drop=True rows are discarded and counted
+    in `dropped` (also recorded in the index) so a live caller keeps its pace.
+    """
+
+    def __init__(self, directory, metadata=None, chunk_size=256, pool=None, max_queued=4, drop=False):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.pool = pool
+        self.index = {'metadata': dict(metadata or {}), 'chunks': []}
+        # Continue an existing export instead of overwriting its chunks
+        index_path = os.path.join(directory, INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+            self.index['metadata'].update(metadata or {})
+        self._next_chunk = len(self.index['chunks'])
+        self._pending = []
+        self.drop = drop
+        self.dropped = self.index.get('dropped', 0)
+        self._dropping = False  # Inside a run of dropped rows, logged once when it starts
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._writer = threading.Thread(target=self._write_chunks, daemon=True)
+        self._writer.start()
+
+    def add(self, timestamp, spectra, frame=None, copy=False, **fields):
+        """Buffer one row. Extra keyword fields (exposure, gain, ...) are stored per row.
+
+        copy=True copies the arrays, for callers that reuse them. A row that
+        is dropped because the writer is behind is never copied.
+        """
+        if self.drop and self._queue.full():
+            self._drop_rows(1)
+            return
+        if copy:
+            spectra = spectra.copy()
+            frame = frame.copy() if frame is not None else None
+        self._pending.append((timestamp, spectra, frame, fields))
+        if len(self._pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        if not self.drop:
+            self._queue.put((self._next_chunk, rows))
+        else:
+            try:
+                self._queue.put_nowait((self._next_chunk, rows))
+            except queue.Full:
+                self._drop_rows(len(rows))
+                return
+            if self._dropping:
+                self._dropping = False
+                logging.info(f"Export writer caught up, {self.dropped} rows dropped so far")
+        self._next_chunk += 1
+
+    def _drop_rows(self, count):
+        self.dropped += count
+        if not self._dropping:
+            self._dropping = True
+            logging.warning(f"Export writer is behind, dropping rows ({self.dropped} so far)")
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._writer.join()
+        if self.dropped != self.index.get('dropped', 0):
+            self._write_index()  # Rows dropped after the last chunk
+
+    def _write_chunks(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self._write_chunk(*item)
+            except Exception:
+                logging.exception("Failed to write export chunk %d", item[0])
+
+    def _write_index(self):
+        self.index['dropped'] = self.dropped
+        index_bytes = json.dumps(self.index, indent=1).encode()
+        _atomic_write(os.path.join(self.directory, INDEX_NAME), lambda f: f.write(index_bytes))
+
+    def _write_chunk(self, number, rows):
+        arrays = {
+            'timestamps': np.array([row[0] for row in rows], dtype=np.float64),
+            'spectra': np.stack([row[1] for row in rows]),
+        }
+        if all(row[2] is not None for row in rows):
+            arrays['frames'] = np.stack([row[2] for row in rows])
+        for key in rows[0][3]:
+            arrays[key] = np.array([row[3].get(key) for row in rows])
+
+        name = f'chunk_{number:05d}.npz'
+        if self.pool is None:
+            write_npz(os.path.join(self.directory, name), **arrays)
+        else:
+            self.pool.submit(write_npz, os.path.join(self.directory, name), **arrays).result()
+        self.index['chunks'].append({
+            'file': name,
+            'count': len(rows),
+            'start': float(arrays['timestamps'][0]),
+            'end': float(arrays['timestamps'][-1]),
+            'frames': 'frames' in arrays,
+        })
+        self._write_index()
+        logging.info(f"Exported {len(rows)} spectra to {name}")
+
+
+def stream_tar(directory, block_size=65536):
+    """Yield a tar archive of an export directory piece by piece.
+
+    Only one block of one file is held in memory at a time, so the archive
+    can be much larger than the Pi's RAM.
+    """
+    base = os.path.basename(os.path.normpath(directory))
+    names = sorted(n for n in os.listdir(directory) if not n.endswith('.tmp'))
+    for name in names:
+        try:
+            f = open(os.path.join(directory, name), 'rb')
+        except FileNotFoundError:
+            continue
+        with f:
+            info = tarfile.TarInfo(f'{base}/{name}')
+            # Size from the open handle, files are only ever replaced, never rewritten in place
+            info.size = os.fstat(f.fileno()).st_size
+            info.mtime = int(time.time())
+            yield info.tobuf(format=tarfile.GNU_FORMAT)
+            remaining = info.size
+            while remaining > 0:
+                data = f.read(min(block_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+            if remaining:
+                yield b'\0' * remaining
+            if info.size % tarfile.BLOCKSIZE:
+                yield b'\0' * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+    yield b'\0' * (2 * tarfile.BLOCKSIZE)
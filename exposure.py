@@ -0,0 +1,54 @@
+import numpy as np
+
+
+class ExposureController:
+    """Closed-loop auto exposure metered on the spectrum itself.
+
+    The camera's own AE looks at the whole scene. This controller looks at
+    the per-row maxima that process_frame already returns for the slit
+    region, and steers ExposureTime/AnalogueGain so the brightest line sits
+    just below saturation. Changes are damped and the controller waits a few
+    frames after each change for the sensor to apply it.
+    """
+
+    def __init__(self, target=220, saturation=250, percentile=99.5, damping=0.5, deadband=0.08,
+                 min_exposure=100, max_exposure=100000, max_gain=8.0, settle_frames=3):
+        self.target = target
+        self.saturation = saturation
+        self.percentile = percentile
+        self.damping = damping
+        self.deadband = deadband
+        self.min_exposure = min_exposure
+        self.max_exposure = max_exposure
+        self.max_gain = max_gain
+        self.settle_frames = settle_frames
+        self._settle = 0
+
+    def update(self, light_color, exposure, gain):
+        """Return new (exposure, gain), or None when no change is needed."""
+        if self._settle > 0:
+            self._settle -= 1
+            return None
+
+        level = float(np.percentile(light_color, self.percentile))
+        if level >= self.saturation:
+            # Clipped, so the true level is unknown: back off hard
+            factor = 0.5
+        elif level <= 0:
+            factor = 4.0
+        else:
+            ratio = self.target / level
+            if abs(np.log(ratio)) < np.log1p(self.deadband):
+                return None
+            factor = ratio ** self.damping
+
+        # Prefer exposure over gain for the same total, gain adds noise
+        total = np.clip(exposure * gain * factor, self.min_exposure, self.max_exposure * self.max_gain)
+        new_exposure = min(total, self.max_exposure)
+        new_gain = max(1.0, total / new_exposure)
+        new_exposure = int(round(new_exposure))
+        new_gain = round(float(new_gain), 2)
+        if new_exposure == exposure and new_gain == gain:
+            return None
+        self._settle = self.settle_frames
+        return new_exposure, new_gain
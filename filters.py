@@ -0,0 +1,76 @@
+import functools
+import math
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+@functools.lru_cache(maxsize=32)
+def savgol_kernel(window, order, deriv=0):
+    """Savitzky-Golay coefficients for an odd `window` and polynomial `order`.
+
+    Least-squares fit of a polynomial to each window, evaluated (or
+    differentiated `deriv` times) at the centre. Built once per parameter set.
+    """
+    if window % 2 == 0 or window <= order:
+        raise ValueError("window must be odd and larger than order")
+    if not 0 <= deriv <= order:
+        raise ValueError("deriv must be between 0 and order")
+    half = window // 2
+    x = np.arange(-half, half + 1, dtype=np.float64)
+    vander = x[:, None] ** np.arange(order + 1)
+    kernel = np.linalg.pinv(vander)[deriv] * math.factorial(deriv)
+    kernel.setflags(write=False)
+    return kernel
+
+
+@functools.lru_cache(maxsize=32)
+def gaussian_kernel(sigma):
+    if not sigma > 0:
+        raise ValueError("sigma must be positive")
+    radius = max(1, int(math.ceil(3 * sigma)))
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    kernel /= kernel.sum()
+    kernel.setflags(write=False)
+    return kernel
+
+
+# Sliding windows along `axis`, edges padded by repeating the end values
+def _windows(values, window, axis):
+    values = np.asarray(values, dtype=np.float64)
+    half = window // 2
+    pad = [(0, 0)] * values.ndim
+    pad[axis] = (half, half)
+    padded = np.pad(values, pad, mode='edge')
+    return sliding_window_view(padded, window, axis=axis)
+
+
+# Correlate every window with `kernel` in a single tensordot over the whole batch
+def apply_kernel(values, kernel, axis=-1, out=None):
+    return np.matmul(_windows(values, len(kernel), axis), kernel, out=out)
+
+
+def median_filter(values, window, axis=-1, out=None):
+    if window < 1 or window % 2 == 0:
+        raise ValueError("window must be odd and at least 1")
+    return np.median(_windows(values, window, axis), axis=-1, out=out)
+
+
+def smooth(values, kind='savgol', axis=-1, window=9, order=2, deriv=0, sigma=2.0, out=None):
+    """Smooth one spectrum or a batch of spectra along `axis`.
+
+    kind is 'savgol', 'gaussian', 'median' or 'none'. Kernels are cached per
+    parameter set, so per frame this is one vectorized pass. The result goes
+    into `out` (float64, same shape as values) when given, except for 'none',
+    which returns `values` itself.
+    """
+    if kind == 'none':
+        return values
+    if kind == 'savgol':
+        return apply_kernel(values, savgol_kernel(window, order, deriv), axis, out)
+    if kind == 'gaussian':
+        return apply_kernel(values, gaussian_kernel(float(sigma)), axis, out)
+    if kind == 'median':
+        return median_filter(values, window, axis, out)
+    raise ValueError(f"Unknown smoothing filter: {kind}")
@@ -0,0 +1,160 @@
+import logging
+import queue
+import threading
+
+import numpy as np
+
+import offload
+import spectral
+
+SATURATION = 250  # Pixel values at or above this are treated as clipped
+
+# Gamma curve of the Raspberry Pi tuning files (rpi.contrast) as (linear, output) pairs on a 16-bit scale,
+# used when the sensor's own tuning file cannot be read
+DEFAULT_GAMMA_CURVE = (
+    0, 0, 1024, 5040, 2048, 9338, 3072, 12356, 4096, 15312, 5120, 18051, 6144, 20790, 7168, 23193,
+    8192, 25744, 9216, 27942, 10240, 30035, 11264, 32005, 12288, 33975, 13312, 35815, 14336, 37600,
+    15360, 39168, 16384, 40642, 18432, 43379, 20480, 45749, 22528, 47753, 24576, 49621, 26624, 51253,
+    28672, 52698, 30720, 53796, 32768, 54876, 36864, 57012, 40960, 58656, 45056, 59954, 49152, 61183,
+    53248, 62355, 57344, 63419, 61440, 64476, 65535, 65535,
+)
+
+
+def tuning_gamma_curve(picam2):
+    """Gamma curve the ISP applies to the main stream, read from the sensor's tuning file."""
+    try:
+        tuning = type(picam2).load_tuning_file(f"{picam2.camera_properties['Model']}.json")
+        return type(picam2).find_tuning_algo(tuning, "rpi.contrast")["gamma_curve"]
+    except Exception as e:
+        logging.warning(f"Using the default gamma curve, the tuning file could not be read: {e}")
+        return DEFAULT_GAMMA_CURVE
+
+
+def linear_table(gamma_curve=DEFAULT_GAMMA_CURVE):
+    """(256,) table mapping 8-bit ISP output back to linear light, on the same 0-255 scale."""
+    curve = np.asarray(gamma_curve, dtype=np.float64).reshape(-1, 2)
+    levels = np.arange(256) * (65535 / 255)
+    return (np.interp(levels, curve[:, 1], curve[:, 0]) * (255 / 65535)).astype(np.float32)
+
+
+def process_linear(frames, table, columns='middle'):
+    """Like spectral.process_frames, with every pixel mapped through `table` to linear light before summing.
+
+    light_color stays in output values, it is only compared against the
+    saturation level. Frames are converted one at a time so a bracket stack
+    never exists in floating point as a whole.
+    """
+    frames = np.asarray(frames)
+    start, end = spectral.column_range(frames.shape[-2], columns)
+    region = frames[..., start:end, :]
+    spectra = np.empty(region.shape[:-2] + region.shape[-1:])
+    for index in np.ndindex(region.shape[:-3]):
+        np.sum(table[region[index]], axis=-2, out=spectra[index])
+    return spectra, np.max(region, axis=-2)
+
+
+def capture_bracket(picam2, exposures, tolerance=0.05, max_wait_frames=6, extract=None):
+    """Capture one frame per exposure time.
+
+    The sensor applies new controls a few frames late, so frames are read
+    until the metadata reports the requested exposure. The exposure actually
+    reported is returned alongside each frame and used for the merge.
+    `extract` turns the accepted request into what is returned in place of
+    the main frame, e.g. spectra from the raw stream.
+    """
+    frames, actual = [], []
+    for exposure in exposures:
+        picam2.set_controls({"ExposureTime": int(exposure)})
+        for _ in range(max_wait_frames):
+            request = picam2.capture_request()
+            try:
+                reported = request.get_metadata().get("ExposureTime", exposure)
+                frame = request.make_array("main") if extract is None else extract(request)
+            finally:
+                request.release()
+            if abs(reported - exposure) <= tolerance * exposure:
+                break
+        else:
+            logging.warning(f"Exposure {exposure} us not reached, got {reported} us")
+        frames.append(frame)
+        actual.append(reported)
+    return frames, np.array(actual, dtype=np.float64)
+
+
+def merge_brackets(spectra, light_color, exposures, saturation=SATURATION):
+    """Merge a bracket set of spectra into one linear spectrum.
+
+    spectra and light_color are (K, N, 3) stacks from K exposures. The
+    spectra must be linear in light, either from the raw stream or from ISP
+    frames through process_linear: the main stream carries the tuning gamma
+    and dividing its sums by exposure time would not line them up. Rows whose
+    brightest pixel is clipped get zero weight for that exposure, the rest
+    are weighted by exposure time (longer exposures have better SNR). The
+    result is scaled to the longest exposure so it reads like a single frame
+    that never saturates.
+    """
+    exposures = np.asarray(exposures, dtype=np.float64)[:, None, None]
+    valid = light_color < saturation
+    total_signal = np.sum(spectra, axis=0, where=valid)
+    total_exposure = np.sum(np.broadcast_to(exposures, valid.shape), axis=0, where=valid)
+    # Rows clipped in every exposure fall back to the shortest one
+    shortest = np.argmin(exposures[:, 0, 0])
+    fallback = spectra[shortest] / exposures[shortest]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        merged = np.where(total_exposure > 0, total_signal / total_exposure, fallback)
+    merged_color = np.max(np.where(valid, light_color, 0), axis=0)
+    return merged * exposures.max(), merged_color
+
+
+# Extract and merge one bracket set, module level so it can run in a worker process
+def process_and_merge(process, frames, exposures, saturation=SATURATION):
+    spectra, light_color = process(frames)
+    return merge_brackets(spectra, light_color, exposures, saturation)
+
+
+class HdrPipeline:
+    """Merge bracket sets on a worker thread while the next set is captured.
+
+    `process` turns a (K, H, W, 3) frame stack into (K, N, 3) linear spectra
+    and light_color stacks, e.g. process_linear with the ISP's gamma
+    inverted. Spectra already extracted from the raw stream go through
+    merge() instead. The latest merged
+    (spectra, light_color) pair is kept in `latest`. With an offload.OffloadPool
+    the frames are stacked straight into shared memory and merged in a
+    worker process, `process` must then be a module-level function.
+    """
+
+    def __init__(self, process, saturation=SATURATION, pool=None):
+        self.process = process
+        self.saturation = saturation
+        self.pool = pool
+        self.latest = None
+        self._queue = queue.Queue(maxsize=1)
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        self._worker.start()
+
+    def submit(self, frames, exposures):
+        # Blocks only if the previous set is still being merged
+        self._queue.put((frames, exposures))
+
+    def merge(self, spectra, light_color, exposures):
+        """Merge a bracket set of spectra right away, they are small enough for the calling thread."""
+        self.latest = merge_brackets(np.stack(spectra), np.stack(light_color), exposures, self.saturation)
+        return self.latest
+
+    def reset(self):
+        self.latest = None
+
+    def _work(self):
+        while True:
+            frames, exposures = self._queue.get()
+            try:
+                if self.pool is None:
+                    self.latest = process_and_merge(self.process, np.stack(frames), exposures, self.saturation)
+                else:
+                    stack = offload.SharedArray((len(frames),) + frames[0].shape, frames[0].dtype)
+                    np.stack(frames, out=stack.array)
+                    self.latest = self.pool.submit(process_and_merge, self.process, stack, exposures,
+                                                   self.saturation).result()
+            except Exception:
+                logging.exception("HDR merge failed")
@@ -0,0 +1,175 @@
+import logging
+import os
+import struct
+import zlib
+
+import numpy as np
+
+# File layout:
+#   two header slots of HEADER_SLOT bytes each, written alternately
+#   capacity fixed-width records: float64 timestamp + float32 values
+# Each header slot carries a sequence number and a CRC32. On open the valid
+# slot with the highest sequence wins, so a crash while writing one slot
+# still leaves the other one intact.
+MAGIC = b'SPHIST01'
+HEADER_FORMAT = '<8sIIIQQQQ'  # magic, version, length, channels, capacity, head, count, seq
+HEADER_SLOT = 4096
+DATA_OFFSET = 2 * HEADER_SLOT
+VERSION = 1
+
+
+class HistoryStore:
+    """Append-only ring of timestamped spectra kept in a memory-mapped file.
+
+    The file is allocated once at its full size, so disk use is bounded by
+    `capacity`. When the ring is full the oldest records are overwritten.
+    Queries slice the memory map directly and only read the pages they touch.
+    """
+
+    def __init__(self, path, length, channels=1, capacity=100000, flush_every=20):
+        self.path = path
+        self.length = length
+        self.channels = channels
+        self.capacity = capacity
+        self.flush_every = flush_every
+        shape = (length,) if channels == 1 else (length, channels)
+        self.record_dtype = np.dtype([('t', '<f8'), ('v', '<f4', shape)])
+        self._seq = 0
+        self._unflushed = 0
+        self._open()
+
+    def _file_size(self):
+        return DATA_OFFSET + self.capacity * self.record_dtype.itemsize
+
+    def _open(self):
+        header = self._read_header() if os.path.exists(self.path) else None
+        if header is not None and header[1:5] != (VERSION, self.length, self.channels, self.capacity):
+            logging.warning("History file %s has a different layout, starting a new one", self.path)
+            os.replace(self.path, self.path + '.old')
+            header = None
+
+        if header is None:
+            with open(self.path, 'wb') as f:
+                f.truncate(self._file_size())
+                # Reserve the blocks now so the ring can never run out of disk later
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(f.fileno(), 0, self._file_size())
+            self.head, self.count = 0, 0
+        else:
+            self.head, self.count, self._seq = header[5], header[6], header[7]
+
+        self._header = np.memmap(self.path, dtype=np.uint8, mode='r+', shape=(DATA_OFFSET,))
+        self.records = np.memmap(self.path, dtype=self.record_dtype, mode='r+',
+                                 offset=DATA_OFFSET, shape=(self.capacity,))
+        if header is None:
+            self._write_header()
+        else:
+            self._recover()
+
+    def _read_header(self):
+        best = None
+        with open(self.path, 'rb') as f:
+            for slot in range(2):
+                f.seek(slot * HEADER_SLOT)
+                raw = f.read(struct.calcsize(HEADER_FORMAT) + 4)
+                if len(raw) < struct.calcsize(HEADER_FORMAT) + 4:
+                    continue
+                body, crc = raw[:-4], struct.unpack('<I', raw[-4:])[0]
+                fields = struct.unpack(HEADER_FORMAT, body)
+                if fields[0] != MAGIC or zlib.crc32(body) != crc:
+                    continue
+                if best is None or fields[7] > best[7]:
+                    best = fields
+        return best
+
+    def _write_header(self):
+        self._seq += 1
+        body = struct.pack(HEADER_FORMAT, MAGIC, VERSION, self.length, self.channels,
+                           self.capacity, self.head, self.count, self._seq)
+        raw = body + struct.pack('<I', zlib.crc32(body))
+        slot = (self._seq % 2) * HEADER_SLOT
+        self._header[slot:slot + len(raw)] = np.frombuffer(raw, dtype=np.uint8)
+
+    def _recover(self):
+        # Records written after the last header update are still in the file.
+        # Walk forward while timestamps keep increasing to pick them up again.
+        last = self.records['t'][(self.head - 1) % self.capacity] if self.count else -np.inf
+        recovered = 0
+        while recovered < self.capacity:
+            t = self.records['t'][self.head]
+            if not np.isfinite(t) or t <= 0 or t <= last:
+                break
+            last = t
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            recovered += 1
+        if recovered:
+            logging.info("Recovered %d history records after unclean shutdown", recovered)
+            self._write_header()
+
+    def append(self, timestamp, values):
+        record = self.records[self.head]
+        record['t'] = timestamp
+        record['v'] = values
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self._unflushed += 1
+        if self._unflushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        # Data pages first, then the header that makes them visible
+        self.records.flush()
+        self._write_header()
+        self._header.flush()
+        self._unflushed = 0
+
+    def _segments(self):
+        # Index ranges of the ring in chronological order
+        if self.count < self.capacity:
+            return [(self.head - self.count, self.head)]
+        return [(self.head, self.capacity), (0, self.head)]
+
+    def _ranges(self, start, end):
+        # Index ranges of the records with start <= t <= end, found by binary search on each segment
+        ranges = []
+        for lo, hi in self._segments():
+            t = self.records['t'][lo:hi]
+            a = lo + np.searchsorted(t, start, side='left')
+            b = lo + np.searchsorted(t, end, side='right')
+            if b > a:
+                ranges.append((a, b))
+        return ranges
+
+    def count_range(self, start=-np.inf, end=np.inf):
+        """Number of records with start <= t <= end, read from the timestamps only."""
+        return sum(b - a for a, b in self._ranges(start, end))
+
+    def query(self, start=-np.inf, end=np.inf, decimate=1, limit=None):
+        """Return (timestamps, values) for records with start <= t <= end.
+
+        With `limit` at most that many records are read, oldest first, so a
+        query never copies more of the ring than that into memory.
+        """
+        decimate = max(1, int(decimate))
+        times, values = [], []
+        skip = 0
+        remaining = limit
+        for a, b in self._ranges(start, end):
+            if remaining is not None and remaining <= 0:
+                break
+            # Keep the decimation phase continuous across the wrap-around
+            selected = self.records[a + skip:b:decimate][:remaining]
+            skip = (skip - (b - a)) % decimate
+            if remaining is not None:
+                remaining -= len(selected)
+            times.append(np.array(selected['t']))
+            values.append(np.array(selected['v']))
+        if not times:
+            return np.empty(0), np.empty((0,) + self.record_dtype['v'].shape, dtype=np.float32)
+        return np.concatenate(times), np.concatenate(values)
+
+    def close(self):
+        self.flush()
+        del self.records
+        del self._header
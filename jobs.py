@@ -0,0 +1,87 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class Job:
+    """A single background job and its result."""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex[:12]
+        self.status = 'queued'  # queued -> running -> done | failed
+        self.created = time.time()
+        self.finished = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'created': self.created,
+            'finished': self.finished,
+            'error': self.error,
+        }
+
+
+class JobQueue:
+    """Run jobs one at a time on a single worker thread.
+
+    Submitting while a job is still waiting to start returns that job
+    instead of queuing another one, so a burst of requests only triggers
+    one run.
+    """
+
+    def __init__(self, run, keep=20):
+        self.run = run
+        self.keep = keep
+        self.jobs = OrderedDict()
+        self._queued = None
+        self._cond = threading.Condition()
+        self._worker = None
+
+    def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._work, daemon=True)
+            self._worker.start()
+
+    def submit(self):
+        with self._cond:
+            if self._queued is not None:
+                return self._queued
+            job = Job()
+            self.jobs[job.id] = job
+            # Forget the oldest finished jobs so results do not pile up in memory
+            while len(self.jobs) > self.keep:
+                oldest = next(iter(self.jobs.values()))
+                if not oldest.done.is_set():
+                    break
+                self.jobs.popitem(last=False)
+            self._queued = job
+            self._cond.notify()
+        self.start()
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while self._queued is None:
+                    self._cond.wait()
+                job = self._queued
+                self._queued = None
+                job.status = 'running'
+            try:
+                job.result = self.run()
+                job.status = 'done'
+            except Exception as e:
+                logging.exception("Job %s failed", job.id)
+                job.error = str(e)
+                job.status = 'failed'
+            job.finished = time.time()
+            job.done.set()
@@ -0,0 +1,115 @@
+import threading
+
+import numpy as np
+
+
+# Parse "480:10,520:10" into [(480.0, 10.0), (520.0, 10.0)], a missing width defaults to `width`
+def parse_bands(text, width=10.0):
+    bands = []
+    for item in text.split(','):
+        centre, _, band_width = item.partition(':')
+        bands.append((float(centre), float(band_width or width)))
+    return bands
+
+
+class KineticsRecorder:
+    """Absorbance in a few wavelength bands, as fast as the camera delivers frames.
+
+    configure() resolves every (centre, width) band to its frame rows once.
+    Per frame only those rows are read: their pixel values are averaged per
+    band and turned into absorbance against the reference. Values go into
+    a preallocated ring of `capacity` samples, the oldest are overwritten.
+    """
+
+    def __init__(self, bands, capacity=60000):
+        self.bands = [(float(centre), float(width)) for centre, width in bands]
+        self.capacity = capacity
+        self.timestamps = np.zeros(capacity)
+        self.values = np.zeros((capacity, len(self.bands)), dtype=np.float32)
+        self.head = 0
+        self.count = 0
+        self.total = 0  # Samples recorded since configure(), including overwritten ones
+        self.reference = None
+        self._rows = None
+        self._starts = None
+        self._sizes = None
+        self._gain = None
+        self._offset = None
+        self._lock = threading.Lock()
+
+    def configure(self, wavelengths, reference, correction=None):
+        """Set the wavelength of every frame row and the reference level of each row.
+
+        `reference` is the mean pixel value per row (channels summed) of the
+        reference, on the same rows. When the reference was dark- and
+        flat-corrected, `correction` is the matching (gain, offset) pair, per
+        row and channel in mean pixel values, and every frame gets the same
+        correction. Recording starts over.
+        """
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        rows, sizes = [], []
+        for centre, width in self.bands:
+            band = np.flatnonzero(np.abs(wavelengths - centre) <= width / 2)
+            if not len(band):
+                band = np.array([np.argmin(np.abs(wavelengths - centre))])  # Narrower than a row, or off the axis
+            rows.append(band)
+            sizes.append(len(band))
+        self._rows = np.concatenate(rows)
+        self._sizes = np.array(sizes)
+        self._starts = np.concatenate([[0], np.cumsum(self._sizes)[:-1]])
+        if correction is not None:
+            self._gain, self._offset = (np.asarray(terms, dtype=np.float64)[self._rows] for terms in correction)
+        else:
+            self._gain = self._offset = None
+        self.reference = self._band_means(np.asarray(reference, dtype=np.float64)[self._rows])
+        with self._lock:
+            self.head = self.count = self.total = 0
+
+    def _band_means(self, row_values):
+        return np.add.reduceat(row_values, self._starts) / self._sizes
+
+    def add(self, timestamp, frame):
+        """Record one (H, W, 3) frame of the slit crop."""
+        if self._gain is None:
+            row_values = frame[self._rows].sum(axis=(1, 2)) / frame.shape[1]
+        else:
+            channel_values = frame[self._rows].sum(axis=1) / frame.shape[1]
+            channel_values *= self._gain
+            channel_values -= self._offset
+            row_values = np.maximum(channel_values, 0).sum(axis=1)  # Clipped like Calibration.apply
+        with np.errstate(divide='ignore', invalid='ignore'):
+            absorbance = -np.log10(self._band_means(row_values) / self.reference)
+        with self._lock:
+            self.timestamps[self.head] = timestamp
+            self.values[self.head] = absorbance
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+            self.total += 1
+
+    def query(self, start=-np.inf, end=np.inf):
+        """(timestamps, absorbance) of the samples in [start, end], oldest first."""
+        with self._lock:
+            order = (self.head - self.count + np.arange(self.count)) % self.capacity
+            timestamps = self.timestamps[order]
+            values = self.values[order]
+        keep = (timestamps >= start) & (timestamps <= end)
+        return timestamps[keep], values[keep]
+
+    def summary(self, window=5.0):
+        """Latest absorbance, its rate of change over the last `window` seconds and the sample rate."""
+        with self._lock:
+            latest = self.timestamps[(self.head - 1) % self.capacity] if self.count else None
+        report = {'bands': [{'centre': c, 'width': w} for c, w in self.bands], 'samples': self.total}
+        if latest is None:
+            return report
+        timestamps, values = self.query(latest - window)
+        report['latest'] = float(latest)
+        span = timestamps[-1] - timestamps[0]
+        report['rate_hz'] = float((len(timestamps) - 1) / span) if span > 0 else 0.0
+        # Least-squares slope of every band at once, a band with no valid reference stays NaN
+        t = timestamps - timestamps.mean()
+        slopes = (t @ values) / (t @ t) if span > 0 else np.zeros(len(self.bands))
+        for band, value, slope in zip(report['bands'], values[-1], slopes):
+            band['absorbance'] = float(value) if np.isfinite(value) else None
+            band['rate'] = float(slope) if np.isfinite(slope) else None  # Absorbance per second
+        return report
@@ -0,0 +1,107 @@
+import glob
+import logging
+import os
+import time
+
+import numpy as np
+
+
+# Read a two-column (wavelength, intensity) CSV file, header and comment lines are skipped
+def load_reference(path):
+    data = np.genfromtxt(path, delimiter=',', comments='#', invalid_raise=False)
+    data = data[np.all(np.isfinite(data), axis=1)]
+    order = np.argsort(data[:, 0])
+    return data[order, 0], data[order, 1]
+
+
+class SpectralLibrary:
+    """Reference spectra resampled onto the device axis as one normalized matrix.
+
+    Every reference file in `directory` becomes one row, resampled onto the
+    current wavelength axis and scaled to unit L2 norm. In 'correlation' mode
+    each row is mean-centred first. Ranking a live spectrum against the whole
+    library is then one matrix-vector product. The matrix is rebuilt only
+    when the wavelength axis or the files change.
+    """
+
+    def __init__(self, directory='library', metric='cosine', check_interval=5.0):
+        self.directory = directory
+        self.metric = metric
+        self.check_interval = check_interval
+        self.names = []
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+        self._references = []
+        self._files_key = None
+        self._axis_key = None
+        self._last_check = 0
+
+    def _normalize(self, values):
+        values = np.asarray(values, dtype=np.float32)
+        if self.metric == 'correlation':
+            values = values - values.mean(axis=-1, keepdims=True)
+        norms = np.linalg.norm(values, axis=-1, keepdims=True)
+        return np.divide(values, norms, out=np.zeros_like(values), where=norms > 0)
+
+    def _scan(self):
+        paths = sorted(glob.glob(os.path.join(self.directory, '*.csv')))
+        return tuple((p, os.path.getmtime(p)) for p in paths)
+
+    def reload(self):
+        self._files_key = self._scan()
+        self.names, self._references = [], []
+        for path, _ in self._files_key:
+            try:
+                self._references.append(load_reference(path))
+                self.names.append(os.path.splitext(os.path.basename(path))[0])
+            except Exception as e:
+                logging.warning(f"Skipping library file {path}: {e}")
+        self._axis_key = None  # Force a rebuild on the next ensure()
+        logging.info(f"Loaded {len(self.names)} library spectra")
+
+    def ensure(self, axis):
+        """Make sure the matrix matches `axis` and the files on disk."""
+        now = time.time()
+        if now - self._last_check > self.check_interval:
+            self._last_check = now
+            if self._scan() != self._files_key:
+                self.reload()
+        axis_key = (len(axis), hash(np.asarray(axis).tobytes()))
+        if axis_key != self._axis_key:
+            self._axis_key = axis_key
+            if self._references:
+                resampled = np.stack([np.interp(axis, wl, values, left=0, right=0)
+                                      for wl, values in self._references])
+                self.matrix = self._normalize(resampled)
+            else:
+                self.matrix = np.empty((0, len(axis)), dtype=np.float32)
+
+    def match(self, spectrum, k=5):
+        """Return the top-k (name, score) pairs for one spectrum on the current axis."""
+        if not len(self.names):
+            return []
+        scores = self.matrix @ self._normalize(spectrum)
+        k = min(k, len(scores))
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [(self.names[i], float(scores[i])) for i in top]
+
+
+# One library per directory and metric in each process, kept between searches
+_libraries = {}
+
+
+def search(directory, axis, spectrum, k=5, metric='cosine', generation=0):
+    """Rank a spectrum against the library in `directory`, for running in a worker process.
+
+    The worker keeps its own SpectralLibrary, so file reloads and resampling
+    happen there too and only the spectrum and the matches are passed around.
+    A `generation` different from the previous call forces a reload.
+    """
+    lib, seen = _libraries.get((directory, metric), (None, None))
+    if lib is None:
+        lib = SpectralLibrary(directory, metric)
+    elif generation != seen:
+        lib.reload()
+    _libraries[(directory, metric)] = (lib, generation)
+    lib.ensure(axis)
+    return lib.match(spectrum, k)
@@ -0,0 +1,74 @@
+# Capture mode selection for high-rate spectral capture.
+#
+# The spectrum runs along the frame rows (process_frame sums across columns),
+# so the row count sets the spectral resolution and the columns only carry
+# the slit image. Modes are chosen to keep the rows and shrink the columns.
+
+import spectral
+
+
+# Frame rate the camera can reach in a mode, also bounded by the exposure time
+def achievable_fps(mode, exposure_time=None):
+    fps = mode['fps']
+    if exposure_time:
+        fps = min(fps, 1e6 / exposure_time)
+    return fps
+
+
+def select_mode(sensor_modes, spectral_pixels):
+    """Pick the fastest sensor mode that still has `spectral_pixels` rows.
+
+    Binned modes read fewer pixels and run faster. They qualify as long as
+    they keep enough rows for the requested spectral resolution. Among
+    equally fast modes the one with more rows wins.
+    """
+    candidates = [m for m in sensor_modes if m['size'][1] >= spectral_pixels]
+    if not candidates:
+        # Nothing is tall enough, fall back to the mode with the most rows
+        return max(sensor_modes, key=lambda m: (m['size'][1], m['fps']))
+    return max(candidates, key=lambda m: (m['fps'], m['size'][1]))
+
+
+# Narrow a ScalerCrop rectangle (x, y, width, height) to the slit columns, keeping every row
+def slit_crop(scaler_crop, columns='middle'):
+    x, y, width, height = scaler_crop
+    start, end = spectral.column_range(width, columns)
+    return (x + start, y, end - start, height)
+
+
+def mode_configuration(picam2, mode, spectral_pixels, spatial_width=240, exposure_time=None, crop=None):
+    """Build a video configuration for `mode` with full spectral rows and binned columns.
+
+    The ISP scales the columns down to `spatial_width`, which averages
+    neighbouring pixels along the slit (spatial binning), and keeps
+    `spectral_pixels` rows. With a ScalerCrop `crop` only that part of the
+    sensor is used, e.g. just the slit. Returns (config, report).
+    """
+    rows = min(spectral_pixels, mode['size'][1])
+    columns = min(spatial_width, mode['size'][0])
+    # ISP output sizes must be even
+    size = (columns // 2 * 2, rows // 2 * 2)
+    fps = achievable_fps(mode, exposure_time)
+    frame_duration = int(1e6 / mode['fps'])
+    # Allow frames to stretch just enough to fit the exposure
+    controls = {"FrameDurationLimits": (frame_duration, max(frame_duration, int(exposure_time or 0)))}
+    if crop is not None:
+        controls["ScalerCrop"] = tuple(int(v) for v in crop)
+    config = picam2.create_video_configuration(
+        main={"size": size, "format": "BGR888"},  # Same pixel order as the still configuration
+        sensor={"output_size": mode['size'], "bit_depth": mode['bit_depth']},
+        controls=controls,
+        buffer_count=4,
+    )
+    report = {
+        'sensor_size': list(mode['size']),
+        'bit_depth': mode['bit_depth'],
+        'output_size': list(size),
+        'spectral_pixels': size[1],
+        'spatial_binning': round(mode['size'][0] / size[0], 2),
+        'mode_fps': mode['fps'],
+        'achievable_fps': round(fps, 1),
+    }
+    if crop is not None:
+        report['crop'] = [int(v) for v in crop]
+    return config, report
@@ -0,0 +1,109 @@
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+SHARE_THRESHOLD = 64 * 1024  # Arrays at least this large go through shared memory instead of pickle
+
+SharedDescriptor = collections.namedtuple('SharedDescriptor', 'name shape dtype')
+
+
+class SharedArray:
+    """A NumPy array backed by a shared memory segment.
+
+    Only its (name, shape, dtype) descriptor crosses the process boundary.
+    Fill `array` in place (e.g. np.stack(frames, out=shared.array)) and pass
+    the object to OffloadPool.submit, which releases the segment once the
+    task has finished.
+    """
+
+    def __init__(self, shape, dtype):
+        dtype = np.dtype(dtype)
+        shape = tuple(int(n) for n in shape)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+        self.descriptor = SharedDescriptor(self.shm.name, shape, dtype.str)
+
+    @classmethod
+    def copy_of(cls, array):
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    def release(self):
+        self.array = None
+        _close(self.shm)
+        self.shm.unlink()
+
+
+# Close a mapping, tolerating views that are still alive somewhere
+def _close(shm):
+    try:
+        shm.close()
+    except BufferError:
+        pass
+
+
+# Worker side: map the shared arguments, run the task, unmap again
+def _call(fn, args, kwargs):
+    segments = []
+
+    def load(value):
+        if isinstance(value, SharedDescriptor):
+            shm = shared_memory.SharedMemory(name=value.name)
+            segments.append(shm)
+            return np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)
+        return value
+
+    try:
+        return fn(*[load(a) for a in args], **{k: load(v) for k, v in kwargs.items()})
+    finally:
+        for shm in segments:
+            _close(shm)
+
+
+class OffloadPool:
+    """A small process pool for analysis that would otherwise hold the GIL.
+
+    Workers are forked when the pool is created, so create it before any
+    threads are started. Tasks get no live state from the parent: pass
+    everything they need as arguments. Arrays of SHARE_THRESHOLD bytes or
+    more are copied once into shared memory instead of being pickled, and
+    results come back through the returned futures.
+    """
+
+    def __init__(self, workers=2):
+        # One tracker shared by everyone, so workers never unlink segments they only borrowed
+        resource_tracker.ensure_running()
+        self.workers = workers
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+        # With fork, the first submit starts every worker
+        self._executor.submit(int).result()
+
+    def submit(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) in a worker process and return a Future."""
+        owned = []
+
+        def pack(value):
+            if isinstance(value, SharedArray):
+                owned.append(value)
+                return value.descriptor
+            if isinstance(value, np.ndarray) and value.nbytes >= SHARE_THRESHOLD:
+                shared = SharedArray.copy_of(value)
+                owned.append(shared)
+                return shared.descriptor
+            return value
+
+        try:
+            future = self._executor.submit(_call, fn, [pack(a) for a in args], {k: pack(v) for k, v in kwargs.items()})
+        except Exception:
+            for shared in owned:
+                shared.release()
+            raise
+        future.add_done_callback(lambda _: [shared.release() for shared in owned])
+        return future
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,126 @@
+import functools
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+import spectral
+
+GRID_COLOR = (225, 225, 225)
+TICK_COLOR = (120, 120, 120)
+TRANSMISSION_COLOR = (0, 0, 255)
+NICE_STEPS = (5, 10, 20, 25, 50, 100, 200)
+
+
+# Pick a round tick spacing in nm that gives at most `max_ticks` ticks
+def tick_step(span, max_ticks):
+    for step in NICE_STEPS:
+        if span / step <= max_ticks:
+            return step
+    return NICE_STEPS[-1]
+
+
+@functools.lru_cache(maxsize=16)
+def plot_background(width, height, coefficients, start, count, reference):
+    """Static part of the plot: gridlines, nm ticks and labels, legend.
+
+    Cached per size, calibration, visible window and reference state, so it
+    is drawn once and every frame only composites onto a copy of it.
+    """
+    img = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(img)
+    font = ImageFont.load_default()
+
+    # Horizontal gridlines at quarter heights
+    for quarter in (1, 2, 3):
+        y = quarter * (height - 1) // 4
+        draw.line([(0, y), (width - 1, y)], fill=GRID_COLOR)
+
+    if count > 1:
+        wavelengths = np.poly1d(coefficients)(np.arange(start, start + count))
+        span = abs(wavelengths[-1] - wavelengths[0])
+        step = tick_step(span, max(2, width // 40))
+        # A tick sits wherever the wavelength crosses a multiple of the step
+        bins = np.floor(wavelengths / step)
+        label_right = -1
+        for x in np.flatnonzero(np.diff(bins)) + 1:
+            draw.line([(x, 0), (x, height - 1)], fill=GRID_COLOR)
+            draw.line([(x, height - 4), (x, height - 1)], fill=TICK_COLOR)
+            label = f"{max(bins[x], bins[x - 1]) * step:.0f}"
+            text_width = draw.textlength(label, font=font)
+            left = int(x - text_width / 2)
+            # Skip labels that would overlap the previous one or run off the edge
+            if left > label_right + 2 and left + text_width < width:
+                draw.text((left, height - 15), label, font=font, fill=TICK_COLOR)
+                label_right = left + text_width
+        draw.text((width - draw.textlength("nm", font=font) - 1, height - 26), "nm", font=font, fill=TICK_COLOR)
+
+    if reference:
+        draw.text((2, height - 26), "T%", font=font, fill=TRANSMISSION_COLOR)
+
+    background = np.array(img)
+    background.setflags(write=False)
+    return background
+
+
+@functools.lru_cache(maxsize=8)
+def column_masks(height):
+    """Tables for vectorized column masks without broadcasting temporaries.
+
+    Column b of `at_or_below` is rows <= b and of `at_or_above` rows >= b, so
+    np.take(table, values, axis=1) gives one (height, len(values)) mask. The
+    last column stands for b = -1, so values clipped to [-1, height - 1]
+    give the same masks as comparing against the unclipped values.
+    """
+    rows = np.arange(height)
+    thresholds = np.append(rows, -1)
+    return rows[:, None] <= thresholds[None, :], rows[:, None] >= thresholds[None, :]
+
+
+def render_plot(spectra, light_color, calibration_polynomial, reference_spectra=None,
+                width=240, height=240, start=0, count=None, out=None):
+    """Plot spectra[start:start + count] as coloured bars hanging from the top edge.
+
+    Bars are composited onto the cached background in one vectorized pass.
+    With a reference, the transmission is drawn as a blue curve on top.
+    Returns a PIL image, or with `out` draws into that (height, width, 3)
+    uint8 array and returns it.
+    """
+    combined_spectra = np.sum(spectra, axis=1)  # Sum across all three channels
+    # A zoom window can reach past the end of a shorter spectrum, e.g. after a mode change
+    count = max(0, min(width if count is None else count, width, len(combined_spectra) - start))
+    background = plot_background(width, height, tuple(calibration_polynomial.coeffs), start, count,
+                                 reference_spectra is not None)
+    canvas = np.empty_like(background) if out is None else out
+    np.copyto(canvas, background)
+    at_or_below, at_or_above = column_masks(height)
+
+    # Normalize the spectra to fit the height of the image
+    max_intensity = np.max(combined_spectra)
+    if max_intensity > 0:
+        window = slice(start, start + count)
+        bars = (combined_spectra[window] / max_intensity * (height - 1)).astype(int)
+        np.clip(bars, -1, height - 1, out=bars)  # Smoothing can dip below zero, those bars stay empty
+
+        # Brightest channel scaled to 255 for each column, like normalize_color
+        colors = light_color[window].astype(np.float64)
+        peak = colors.max(axis=1, keepdims=True)
+        colors = np.where(peak > 0, colors * (255 / np.where(peak > 0, peak, 1)), colors).astype(np.uint8)
+
+        region = canvas[:, :count]
+        np.copyto(region, colors[None, :, :], where=np.take(at_or_below, bars, axis=1)[..., None])
+
+        # If reference spectra is provided, plot the transmission
+        if reference_spectra is not None:
+            combined_reference_spectra = np.sum(reference_spectra, axis=1)[window]
+            transmission = spectral.transmission(combined_spectra[window], combined_reference_spectra)
+            max_transmission = np.max(transmission)
+            if max_transmission > 0:
+                curve = (transmission / max_transmission * (height - 1)).astype(int)
+                np.clip(curve, -1, height - 1, out=curve)
+                # Join each point to its left neighbour so the curve has no gaps
+                previous = np.concatenate([curve[:1], curve[:-1]])
+                low, high = np.minimum(curve, previous), np.maximum(curve, previous)
+                band = np.take(at_or_below, high, axis=1)
+                band &= np.take(at_or_above, low, axis=1)
+                np.copyto(region, np.array(TRANSMISSION_COLOR, dtype=np.uint8), where=band[..., None])
+    return Image.fromarray(canvas) if out is None else canvas
@@ -0,0 +1,129 @@
+import re
+
+import numpy as np
+
+import buffers
+
+# Offsets (row, column) of the R, G1, G2 and B sites inside a 2x2 Bayer cell
+BAYER_SITES = {
+    'RGGB': ((0, 0), (0, 1), (1, 0), (1, 1)),
+    'GRBG': ((0, 1), (0, 0), (1, 1), (1, 0)),
+    'GBRG': ((1, 0), (0, 0), (1, 1), (0, 1)),
+    'BGGR': ((1, 1), (0, 1), (1, 0), (0, 0)),
+}
+
+
+# Split a libcamera raw format name such as 'SRGGB10_CSI2P' into (order, bits, packed)
+def parse_format(fmt):
+    # Compressed formats such as 'SRGGB16_PISP_COMP1' are not handled and rejected
+    match = re.fullmatch(r'S([RGB]{4})(\d+)(_CSI2P)?', fmt)
+    if match is None:
+        raise ValueError(f"Not a Bayer format: {fmt}")
+    return match.group(1), int(match.group(2)), match.group(3) is not None
+
+
+# Name of the unpacked variant of the sensor's native format, e.g. 'SRGGB10'
+def unpacked_format(sensor_format):
+    return sensor_format.split('_')[0]
+
+
+# Pixels per packed group and bytes per group for each packed bit depth
+PACKING = {10: (4, 5), 12: (2, 3)}
+
+
+def unpack(raw, bits, packed, col_start, col_end):
+    """Turn a raw (H, stride) uint8 buffer into uint16 pixels for columns col_start:col_end.
+
+    Only the requested columns are unpacked. For MIPI CSI-2 packed data the
+    range must be aligned to a packing group, which `slit_columns` ensures.
+    """
+    if not packed:
+        return raw.view('<u2')[:, col_start:col_end]
+
+    pixels, nbytes = PACKING[bits]
+    groups = raw[:, col_start // pixels * nbytes:col_end // pixels * nbytes]
+    groups = groups.reshape(raw.shape[0], -1, nbytes).astype(np.uint16)
+    if bits == 10:
+        # Four 8-bit MSBs followed by one byte with the four 2-bit LSBs
+        low = groups[..., 4:5] >> np.array([0, 2, 4, 6], dtype=np.uint16) & 0x3
+        out = (groups[..., :4] << 2) | low
+    else:
+        # Two 8-bit MSBs followed by one byte with both 4-bit LSBs
+        low = groups[..., 2:3] >> np.array([0, 4], dtype=np.uint16) & 0xF
+        out = (groups[..., :2] << 4) | low
+    return out.reshape(raw.shape[0], -1)
+
+
+# Column range of the middle third of the sensor, aligned for unpacking and Bayer cells
+def slit_columns(width, bits, packed):
+    align = PACKING[bits][0] if packed else 2
+    align = max(align, 2)
+    return width // 3 // align * align, 2 * width // 3 // align * align
+
+
+def raw_spectra(raw, fmt, width, black_level=0):
+    """Extract linear per-colour spectra from the slit region of a raw Bayer frame.
+
+    Returns (spectra, light_color) shaped (H/2, 3) like process_frame: spectra
+    holds the black-level corrected sum of each colour site per Bayer row
+    pair (the two green sites averaged), light_color the per-row maximum
+    scaled to 8 bits so the rest of the pipeline can treat it the same.
+    """
+    order, bits, packed = parse_format(fmt)
+    col_start, col_end = slit_columns(width, bits, packed)
+    pixels = unpack(raw, bits, packed, col_start, col_end)
+    height = pixels.shape[0] // 2 * 2
+    pixels = pixels[:height]
+
+    (r_y, r_x), (g1_y, g1_x), (g2_y, g2_x), (b_y, b_x) = BAYER_SITES[order]
+    sites = np.stack([
+        pixels[r_y::2, r_x::2],
+        pixels[g1_y::2, g1_x::2],
+        pixels[g2_y::2, g2_x::2],
+        pixels[b_y::2, b_x::2],
+    ], axis=-1).astype(np.float32)
+    sites -= black_level
+    np.maximum(sites, 0, out=sites)
+
+    sums = sites.sum(axis=1)
+    spectra = np.stack([sums[:, 0], (sums[:, 1] + sums[:, 2]) / 2, sums[:, 3]], axis=1)
+    maxima = sites.max(axis=1)
+    light_color = np.stack([maxima[:, 0], np.maximum(maxima[:, 1], maxima[:, 2]), maxima[:, 3]], axis=1)
+    light_color = (light_color * (255 / ((1 << bits) - 1 - black_level))).astype(np.uint8)
+    return spectra, light_color
+
+
+def request_spectra(request, fmt, width):
+    """raw_spectra of a captured request, read in place from the mapped raw buffer.
+
+    Only the slit columns are unpacked, the rest of the frame is never copied.
+    """
+    from picamera2 import MappedArray  # Deferred like the Picamera2 import in init_camera
+    bits = parse_format(fmt)[1]
+    with MappedArray(request, 'raw') as mapped:
+        buffer = mapped.array.view(np.uint8)
+        return raw_spectra(buffer.reshape(buffer.shape[0], -1), fmt, width,
+                           black_level(request.get_metadata(), bits))
+
+
+def capture_with_raw(picam2, pool, name, fmt, width):
+    """Capture the main frame into a pooled buffer and the raw slit spectra from one request.
+
+    Returns (frame, (spectra, light_color)).
+    """
+    size = picam2.camera_configuration()['main']['size']
+    request = picam2.capture_request()
+    try:
+        frame = buffers.copy_stream(request, pool, name, size)
+        spectra = request_spectra(request, fmt, width)
+    finally:
+        request.release()
+    return frame, spectra
+
+
+# Black level in raw counts from libcamera metadata, which reports it on a 16-bit scale
+def black_level(metadata, bits):
+    levels = metadata.get('SensorBlackLevels')
+    if not levels:
+        return 0
+    return int(np.mean(levels)) >> (16 - bits)
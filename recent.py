@@ -0,0 +1,65 @@
+import concurrent.futures
+import queue
+
+import numpy as np
+
+
+class RecentSpectra:
+    """The last `size` processed spectra, copied into a preallocated ring.
+
+    The live loop adds every spectrum it computes, so a reference can be
+    taken as the mean of the latest frames without another capture. A new
+    spectrum geometry, e.g. after a mode change, starts the ring over.
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self.ring = None
+        self.head = 0
+        self.count = 0
+
+    def add(self, spectra):
+        if self.ring is None or self.ring.shape[1:] != spectra.shape:
+            self.ring = np.zeros((self.size,) + spectra.shape)
+            self.head = self.count = 0
+        self.ring[self.head] = spectra
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def average(self, count=None):
+        """Mean of the last `count` spectra (all of them by default), None before the first one."""
+        if not self.count:
+            return None
+        count = min(count or self.count, self.count)
+        order = (self.head - count + np.arange(count)) % self.size
+        return self.ring[order].mean(axis=0)
+
+
+class CommandQueue:
+    """Requests from button callbacks and web handlers, run by the live loop between frames.
+
+    post() returns a Future for the result, so a handler can wait for it
+    while the callback threads never touch the camera or the loop's state.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def post(self, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def run_pending(self):
+        """Call once per loop iteration, from the loop thread."""
+        while True:
+            try:
+                future, fn, args, kwargs = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
@@ -5,10 +5,14 @@ import ST7789
 import time
 from picamera2 import Picamera2
 from gpiozero import Button
-from flask import Flask, send_file, render_template_string
+from flask import Flask, Response, send_file, render_template_string
 import threading
 import io
 import spidev as SPI
+import stream
+import spectral
+import recent
+import waterfall
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -40,22 +44,32 @@ button1 = Button(KEY1_PIN)
 button2 = Button(KEY2_PIN)
 
 # Variables to control the display mode and reference spectra
-display_mode = 0  # 0: camera, 1: plot
+display_mode = 0  # 0: camera, 1: plot, 2: waterfall
 reference_spectra = None
+REFERENCE_FRAMES = 8  # Latest spectra averaged into a reference
+recent_spectra = recent.RecentSpectra(16)
+loop_commands = recent.CommandQueue()  # Button presses are carried out by the main loop
+SLIT_COLUMNS = 'full'  # The whole frame width is summed into the spectrum
 current_plot = Image.new('RGB', (240, 240), 'white')  # Initialize current_plot
 current_camera_image = Image.new('RGB', (240, 240), 'black')  # Initialize current_camera_image
+spectrum_waterfall = waterfall.Waterfall(disp.width, disp.height)
+WATERFALL_CURSOR = np.full((1, disp.width, 3), 255, dtype=np.uint8)  # Marks the row the next spectrum goes to
 
 def toggle_display_mode():
     global display_mode
-    display_mode = (display_mode + 1) % 2  # Cycle through 2 modes (0 and 1)
+    display_mode = (display_mode + 1) % 3  # Cycle through 3 modes (0, 1 and 2)
     logging.info(f"Display mode: {display_mode}")
 
-def capture_reference_spectra():
+# Runs on the main loop: the reference is the mean of the latest spectra, the camera is not touched
+def set_reference():
     global reference_spectra
-    global picam2
-    frame = picam2.capture_array()
-    reference_spectra, _ = process_frame(frame)
-    logging.info("Reference spectra captured")
+    spectra = recent_spectra.average(REFERENCE_FRAMES)
+    if spectra is not None:
+        reference_spectra = spectra
+        logging.info("Reference spectra captured")
+
+def capture_reference_spectra():
+    loop_commands.post(set_reference)
 
 button1.when_pressed = toggle_display_mode
 button2.when_pressed = capture_reference_spectra
@@ -63,26 +77,24 @@ button2.when_pressed = capture_reference_spectra
 # Flask setup
 app = Flask(__name__)
 
+# Live MJPEG streams, each frame is encoded once and shared by all viewers
+camera_stream = stream.FrameBroadcaster()
+plot_stream = stream.FrameBroadcaster()
+waterfall_stream = stream.FrameBroadcaster(lambda w: stream.mjpeg_part(w.image()))
+
 @app.route('/')
 def index():
     return render_template_string("""
     <!doctype html>
     <title>Spectra Plot and Camera View</title>
     <h1>Spectra Plot</h1>
-    <img id="plot" src="/plot.png" alt="Spectra Plot">
+    <img id="plot" src="/plot.mjpg" alt="Spectra Plot">
     <h1>Camera View</h1>
-    <img id="camera" src="/camera.png" alt="Camera View">
+    <img id="camera" src="/camera.mjpg" alt="Camera View">
+    <h1>Waterfall</h1>
+    <img id="waterfall" src="/waterfall.mjpg" alt="Waterfall">
     <br>
     <a href="/fullres">Capture Full-Resolution Image</a>
-    <script>
-        function refreshImage(id, url) {
-            document.getElementById(id).src = url + '?t=' + new Date().getTime();
-        }
-        setInterval(() => {
-            refreshImage('plot', '/plot.png');
-            refreshImage('camera', '/camera.png');
-        }, 1000);
-    </script>
     """)
 
 @app.route('/fullres')
@@ -93,18 +105,9 @@ def fullres():
     <h1>Full Resolution Image</h1>
     <img id="fullres" src="/fullres_image.png" alt="Full Resolution Image">
     <h1>Camera View</h1>
-    <img id="camera" src="/camera.png" alt="Camera View">
+    <img id="camera" src="/camera.mjpg" alt="Camera View">
     <br>
     <a href="/">Back to Main Page</a>
-    <script>
-        function refreshImage(id, url) {
-            document.getElementById(id).src = url + '?t=' + new Date().getTime();
-        }
-        setInterval(() => {
-            // refreshImage('fullres', '/fullres_image.png');
-            refreshImage('camera', '/camera.png');
-        }, 1000);
-    </script>
     """)
 
 @app.route('/plot.png')
@@ -123,6 +126,18 @@ def camera_png():
     img_io.seek(0)
     return send_file(img_io, mimetype='image/png')
 
+@app.route('/camera.mjpg')
+def camera_mjpg():
+    return Response(camera_stream.stream(), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/plot.mjpg')
+def plot_mjpg():
+    return Response(plot_stream.stream(), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/waterfall.mjpg')
+def waterfall_mjpg():
+    return Response(waterfall_stream.stream(), mimetype='multipart/x-mixed-replace; boundary=frame')
+
 @app.route('/fullres_image.png')
 def capture_full_res_image():
     global picam2
@@ -142,7 +157,7 @@ def capture_full_res_image():
 
     # Process the full-resolution image
     full_res_image = Image.open("full_res.jpg")
-    spectra, light_color = process_frame(np.array(full_res_image))
+    spectra, light_color = spectral.process_frames(np.array(full_res_image), SLIT_COLUMNS)
     spectra_img = plot_spectra(spectra, light_color, reference_spectra, width=640, height=480)  # Larger plot size
     img_io = io.BytesIO()
     spectra_img.save(img_io, 'PNG')
@@ -152,13 +167,6 @@ def capture_full_res_image():
 def start_flask():
     app.run(host='0.0.0.0', port=5000)
 
-# Function to process the image and extract the spectra
-def process_frame(frame):
-    # Sum the pixel values along the horizontal axis to get the combined spectra
-    spectra = np.sum(frame, axis=1)
-    light_color = np.max(frame, axis=1)
-    return spectra, light_color
-
 # Function to plot the spectra
 def plot_spectra(spectra, light_color, reference_spectra=None, width=240, height=240):
     spectra_img = Image.new('RGB', (width, height), 'white')
@@ -176,9 +184,8 @@ def plot_spectra(spectra, light_color, reference_spectra=None, width=240, height
     # If reference spectra is provided, plot the transmission
     if reference_spectra is not None:
         combined_reference_spectra = np.sum(reference_spectra, axis=1)
-        with np.errstate(divide='ignore', invalid='ignore'):
-            transmission = np.where(combined_reference_spectra > 0, (combined_spectra / combined_reference_spectra) * 100, 0)
-        max_transmission = np.max(transmission[np.isfinite(transmission)])
+        transmission = spectral.transmission(combined_spectra, combined_reference_spectra)
+        max_transmission = np.max(transmission)
         if max_transmission > 0:
             normalized_transmission = (transmission / max_transmission * (width - 1)).astype(int)
             for y, intensity in enumerate(normalized_transmission):
@@ -208,20 +215,36 @@ def main():
     flask_thread.daemon = True
     flask_thread.start()
 
+    shown_mode = None  # Display mode of the previous frame
     while True:
         try:
             start = time.time()
+            loop_commands.run_pending()
             frame = picam2.capture_array()
             camera_img = Image.fromarray(frame)
             current_camera_image = camera_img  # Save the current camera image to be served by Flask
+            camera_stream.publish(camera_img)
+
+            # Every frame feeds the recent spectra, so a reference is ready whatever is shown
+            spectra, light_color = spectral.process_frames(frame, SLIT_COLUMNS)
+            recent_spectra.add(spectra)
+            waterfall_row = spectrum_waterfall.add(np.sum(spectra, axis=1))
+            waterfall_stream.publish(spectrum_waterfall)
 
             if display_mode == 0:
                 display_on_lcd(camera_img)
             elif display_mode == 1:
-                spectra, light_color = process_frame(frame)
                 spectra_img = plot_spectra(spectra, light_color, reference_spectra)
                 current_plot = spectra_img  # Save the current plot to be served by Flask
+                plot_stream.publish(spectra_img)
                 display_on_lcd(spectra_img)
+            elif display_mode == 2:
+                if shown_mode != 2:
+                    disp.ShowArray(spectrum_waterfall.buffer)  # Whole image once, then a row per frame
+                else:
+                    disp.ShowRows(spectrum_waterfall.buffer[waterfall_row:waterfall_row + 1], waterfall_row)
+                disp.ShowRows(WATERFALL_CURSOR, spectrum_waterfall.head)
+            shown_mode = display_mode
 
             logging.info(f'Frame processing time: {time.time() - start}')
             time.sleep(0.1)  # Short delay between frames
@@ -1,56 +1,152 @@
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 import logging
 import ST7789
 import LCD_side
 import time
-from picamera2 import Picamera2
 from gpiozero import Button
-from flask import Flask, send_file, render_template_string
+from flask import Flask, Response, abort, jsonify, request, send_file, render_template_string
 import threading
 import io
+import json
 import spidev as SPI
+import stream
+import jobs
+import history
+import export
+import hdr
+import exposure
+import raw
+import modes
+import filters
+import tracker
+import library
+import calibrate
+import colorimetry
+import text_panel
+import plotting
+import startup
+import offload
+import buffers
+import spectral
+import kinetics
+import correction
+import recent
+import waterfall
+import gc
+import functools
+import glob
+import os
 from datetime import datetime
-from libcamera import controls
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 
-# Initialize the main display
-disp_main = ST7789.ST7789(spi=SPI.SpiDev(1, 0), spi_freq=10000000, rst=27, dc=22, bl=19)
-disp_main.Init()
-disp_main.clear()
-disp_main.bl_DutyCycle(100)
-disp_main.bl_Frequency(1000)
-
-# Initialize the side display
-disp_side1 = LCD_side.LCD_side(spi=SPI.SpiDev(0, 1), spi_freq=10000000, rst=23, dc=5, bl=12)
-disp_side1.Init()
-disp_side1.clear()
-disp_side1.bl_DutyCycle(100)
-disp_side1.bl_Frequency(1000)
-
-disp_side2 = LCD_side.LCD_side(spi=SPI.SpiDev(0, 0), spi_freq=10000000, rst=24, dc=4, bl=13)
-disp_side2.Init()
-disp_side2.clear()
-disp_side2.bl_DutyCycle(100)
-disp_side2.bl_Frequency(1000)
+# Displays, camera and buttons are brought up in main() by start_hardware()
+disp_main = None
+disp_side1 = None
+disp_side2 = None
+picam2 = None
 
+# Worker processes for heavy analysis, forked first thing in main() before any thread starts
+OFFLOAD_WORKERS = 2
+offload_pool = None
 
+# Timing of the startup steps, reported once the first spectrum is shown
+startup_timer = startup.Startup()
 
 # GPIO Pin Definitions
 KEY1_PIN = 25
 KEY2_PIN = 26
 KEY3_PIN = 16
 
-# Initialize buttons
-button1 = Button(KEY1_PIN)
-button2 = Button(KEY2_PIN)
+button1 = None
+button2 = None
+button3 = None
 
 # Variables to control the reference spectra
 reference_spectra = None
-current_plot = Image.new('RGB', (240, 240), 'white')  # Initialize current_plot
-current_camera_image = Image.new('RGB', (240, 240), 'black')  # Initialize current_camera_image
+reference_width = None  # Width of the frame the reference came from, for the per-pixel reference level
+REFERENCE_FRAMES = 8  # Latest spectra averaged into a reference
+reference_correction = None  # (gain, offset) of the dark/flat correction the reference went through
+spectra_calibration = None  # Correction applied to the latest live spectra, None when uncorrected
+recent_spectra = recent.RecentSpectra(16)
+loop_commands = recent.CommandQueue()  # Work for the live loop from buttons and web handlers
+# Latest plot and camera frame as RGB arrays, images are only built when someone asks for them
+current_plot = np.full((240, 240, 3), 255, dtype=np.uint8)  # Initialize current_plot
+current_camera_image = np.zeros((240, 240, 3), dtype=np.uint8)  # Initialize current_camera_image
+
+# Per-frame arrays of the live loop, allocated once per geometry and reused.
+# Frames and plots alternate between two buffers so Flask can still read the previous one.
+frame_buffers = buffers.BufferPool()
+allocation_check = buffers.AllocationCheck()  # Armed over HTTP, see /diagnostics/allocations
+spectrum_length = 0  # Number of points in the latest spectrum, used for the wavelength axis
+history_store = None  # Created on the first frame, once the spectrum length is known
+HISTORY_PATH = 'spectrum_history_{length}.bin'  # One file per spectrum length, a mode change keeps the others
+HISTORY_CAPACITY = 100000  # Records kept on disk (about 430 MB for 1080-point spectra)
+HISTORY_FILE_BYTES = 440 * 1024 * 1024  # Longer spectra get fewer records, so no file grows past this
+HISTORY_FILES = 2  # Files of other lengths beyond the most recently used ones are deleted
+HISTORY_MAX_ROWS = 500  # Rows per /history response (about 2 MB at 1080 points), larger ranges are decimated or paged
+
+# Compressed, chunked exports of spectra and full-resolution captures
+EXPORT_DIR = 'exports'
+export_session = None  # Active live export, started and stopped over HTTP
+export_frames = False  # Whether the active export also stores camera frames
+export_lock = threading.Lock()
+capture_archive = None  # Full-resolution captures, created in main()
+
+# HDR exposure bracketing, frames of each set are merged into one spectrum
+hdr_mode = False
+hdr_exposures = [2500, 10000, 40000]  # Exposure times in microseconds, shortest first
+hdr_pipeline = None  # Merge worker, created in main()
+
+# Spectral auto exposure, metered on the slit region only
+auto_exposure = False
+exposure_controller = exposure.ExposureController()
+
+# Raw Bayer capture, spectra come straight from the sensor data instead of the ISP output
+raw_mode = False
+raw_stream_config = None  # Format and size of the raw stream while raw_mode is on
+RAW_MAIN_SIZE = (640, 360)  # Main stream in raw mode, only shown on the displays and the camera stream
+
+# Smoothing applied ahead of peak detection and plotting, see filters.smooth
+smoothing = {'kind': 'savgol', 'window': 9, 'order': 2}
+
+# Peaks matched across frames, so each line keeps its ID and a smoothed wavelength
+peak_tracker = tracker.PeakTracker()
+
+# Reference spectra ranked against every frame, files are read from the library directory
+# The ranking itself runs in the offload workers, each with its own copy of the library
+LIBRARY_DIR = 'library'
+spectral_library = library.SpectralLibrary(LIBRARY_DIR)
+library_generation = 0  # Bumped on /library/reload so the workers reload too
+library_matches = []  # Top matches for the latest frame as (name, score)
+
+# CIE colorimetry of every frame, exposed on the peaks panel and over HTTP
+colorimeter = colorimetry.Colorimeter()
+color_measurement = None  # XYZ, xy, uv, CCT and Duv of the latest frame
+
+# Dark level and flat-field gain per exposure/gain setting, applied to every live spectrum
+CORRECTION_DIR = 'corrections'
+correction_store = correction.CorrectionStore(CORRECTION_DIR)
+correction_on = True
+
+# Spectra over time, one colour-coded row per frame, shown on the main display instead of the camera
+spectrum_waterfall = waterfall.Waterfall(240, 240)
+waterfall_mode = False
+WATERFALL_CURSOR = np.full((1, 240, 3), 255, dtype=np.uint8)  # Marks the row the next spectrum goes to
+
+# Report of the high-rate capture mode in use, None for the default still configuration
+capture_mode = None
+
+# Kinetics mode: absorbance in a few bands from a slit-only crop, as fast as the sensor allows
+KINETICS_BANDS = '450:10,550:10,650:10'  # Default bands as centre:width in nm
+KINETICS_CAPACITY = 60000  # Samples kept in memory, 10 minutes at 100 Hz
+KINETICS_PANEL_INTERVAL = 0.5  # Seconds between side panel updates
+kinetics_on = False
+kinetics_recorder = None  # Recorder of the latest run, kept after stopping so its data can be fetched
+kinetics_mode = None  # Report of the slit-cropped capture mode
+kinetics_clock = 0.0  # Offset from the sensor timestamps to wall-clock time
 
 # Calibration data (pixel positions and corresponding wavelengths)
 pixel_positions = np.array([i/1.5 for i in [215, 195, 159, 123, 79.5]])
@@ -59,6 +155,16 @@ wavelengths = np.array([405.4, 436.6, 487.7, 546.5, 611.6])
 # Fit a second-degree polynomial to the calibration data
 coefficients = np.polyfit(pixel_positions, wavelengths, 2)
 calibration_polynomial = np.poly1d(coefficients)
+HAND_CALIBRATION_LENGTH = 240  # Spectrum points the positions above were measured on
+
+# Saved automatic calibrations replace the hand-measured one. Raw spectra get their own, the raw
+# rows span the whole sensor height rather than the ISP output crop.
+CALIBRATION_PATHS = {'isp': 'calibration.json', 'raw': 'calibration_raw.json'}
+calibrations = {'isp': (calibration_polynomial, HAND_CALIBRATION_LENGTH)}  # Polynomial and the length it was fit on
+for calibration_source, calibration_path in CALIBRATION_PATHS.items():
+    saved_calibration = calibrate.load_calibration(calibration_path)
+    if saved_calibration is not None:
+        calibrations[calibration_source] = saved_calibration
 
 # Add zoom and navigation variables
 zoomed = False
@@ -66,35 +172,181 @@ zoom_window_start = 0
 zoom_window_size = 160  # Number of pixels in the zoom window
 total_spectra_length = 240  # Assuming the spectra have 240 pixels in width
 
+# Serializes camera access between the live loop and full-resolution captures
+camera_lock = threading.Lock()
+preview_config = None
+
+# Fixed camera settings, reapplied whenever the camera is reconfigured
+camera_controls = {
+    "ExposureTime": 20000,        # Set the exposure time in microseconds
+    "AnalogueGain": 1.0,          # Set the analogue gain
+    "AwbEnable": False,           # Disable automatic white balance
+    "AeEnable": False,            # Disable automatic exposure
+#    "AfMode": 0,                  # Manual autofocus mode (libcamera controls.AfModeEnum.Manual)
+#    "LensPosition": 0.5           # Set the lens position for manual focus
+}
+
 def capture_full_res_image():
     timestamp = datetime.now().isoformat()
     global picam2
-    picam2.stop()
-    config = picam2.create_still_configuration(main={"size": (1920, 1080)})  # Full resolution
-    picam2.configure(config)
-    picam2.start()
-    picam2.capture_file(f"full_res_{timestamp}.jpg")
-    picam2.stop()
+    # Hold the camera for the whole reconfiguration so the live loop waits instead of racing it
+    with camera_lock:
+        if kinetics_on:
+            raise RuntimeError("Kinetics mode is on")  # Queued before kinetics started, the job fails
+        picam2.stop()
+        config = picam2.create_still_configuration(main={"size": (1920, 1080)})  # Full resolution
+        picam2.configure(config)
+        picam2.start()
+        picam2.set_controls(camera_controls)
+        frame = picam2.capture_array()
+        picam2.stop()
 
-    # Reconfigure the camera for the regular preview mode
-    config = picam2.create_still_configuration(main={"size": (160,160)})
-    picam2.configure(config)
-    picam2.start()
+        # Reconfigure the camera for the regular preview mode
+        picam2.configure(preview_config)
+        picam2.start()
+        picam2.set_controls(camera_controls)
 
-    # Process the full-resolution image
-    full_res_image = Image.open(f"full_res_{timestamp}.jpg")
-    spectra, light_color = process_frame(np.array(full_res_image))
-    spectra_img = plot_spectra(spectra, light_color, reference_spectra, width=640, height=480)  # Larger plot size
-    spectra_img.save(f"full_res_plot_{timestamp}.png")
+    # Analyse the full-resolution image in a worker process, live capture continues meanwhile
+    full_res_image = Image.fromarray(frame)
+    # A reference taken in a high-rate mode has other rows than the full-resolution frame
+    reference = reference_spectra if reference_spectra is not None and len(reference_spectra) == frame.shape[0] else None
+    spectra, light_color, spectra_img = offload_pool.submit(
+        analyze_full_res, frame, calibration_for(frame.shape[0], 'isp'), reference, *plot_window()).result()
+    capture_archive.add(time.time(), spectra, frame, light_color=light_color, **camera_settings())
 
     logging.info("Full-resolution photo and plot captured")
+    return {
+        'timestamp': timestamp,
+        'image': full_res_image,
+        'spectra': spectra,
+        'light_color': light_color,
+        'plot': spectra_img,
+    }
 
-def capture_reference_spectra():
-    global reference_spectra
-    global picam2
-    frame = picam2.capture_array()
-    reference_spectra, _ = process_frame(frame)
-    logging.info("Reference spectra captured")
+# Spectra and a larger plot of one full-resolution frame, everything it needs comes in as arguments
+def analyze_full_res(frame, calibration, reference, start, count):
+    spectra, light_color = process_frame(frame)
+    plot = plotting.render_plot(spectra, light_color, calibration, reference,
+                                width=640, height=480, start=start, count=count)
+    return spectra, light_color, plot
+
+# Format and pixel width of the raw stream, as the raw module takes them
+def raw_geometry():
+    return raw_stream_config['format'], raw_stream_config['size'][0]
+
+# Main frame and raw spectra of one HDR bracket request
+def raw_bracket_frame(request):
+    return (request.make_array('main'),) + raw.request_spectra(request, *raw_geometry())
+
+# Calibration polynomial for spectra of `length` points from `source` ('isp' or 'raw', the live one by default),
+# rescaled from the length it was fit on. Raw spectra use the ISP calibration until /calibrate runs in raw mode.
+def calibration_for(length, source=None):
+    source = source or ('raw' if raw_mode else 'isp')
+    polynomial, fit_length = calibrations.get(source, calibrations['isp'])
+    return calibrate.rescale(polynomial, fit_length, length)
+
+# Per-row camera settings stored alongside exported spectra
+def camera_settings():
+    return {'exposure': camera_controls["ExposureTime"], 'gain': camera_controls["AnalogueGain"]}
+
+# Session metadata written to index.json of every export
+def export_metadata():
+    return {
+        'created': datetime.now().isoformat(),
+        'calibration': calibration_for(spectrum_length).coeffs.tolist(),
+        'controls': {k: v for k, v in camera_controls.items() if isinstance(v, (int, float, bool))},
+    }
+
+# Full-resolution captures run on one background worker, requests poll for the result.
+# Each result holds the full image and plot (about 7 MB) and every capture is archived anyway, so keep a few.
+full_res_jobs = jobs.JobQueue(capture_full_res_image, keep=3)
+
+# Runs on the live loop: the reference is the mean of the latest spectra, the camera is not touched
+def set_reference(frames=REFERENCE_FRAMES):
+    global reference_spectra, reference_width, reference_correction
+    spectra = recent_spectra.average(frames)
+    if spectra is None:
+        return None
+    reference_spectra = spectra
+    # Kept as it is now, a later dark or flat capture must not change what the reference went through
+    reference_correction = spectra_calibration.terms() if spectra_calibration is not None else None
+    reference_width = current_camera_image.shape[1]
+    logging.info(f"Reference spectra captured from {min(frames, recent_spectra.count)} frames")
+    return len(spectra)
+
+# A new capture geometry changes the spectrum length, the old reference no longer lines up
+def clear_reference():
+    global reference_spectra, reference_width, reference_correction
+    if reference_spectra is not None:
+        reference_spectra = reference_width = reference_correction = None
+        logging.info("Reference spectra cleared, the spectrum length changed")
+
+# Safe from any thread, returns a Future for the number of reference rows (None before the first frame)
+def capture_reference_spectra(frames=REFERENCE_FRAMES):
+    return loop_commands.post(set_reference, frames)
+
+# Wavelength, reference level and dark/flat correction of each row of a kinetics frame with `rows` rows.
+# The slit crop spans the same rows as the preview, so rows map onto the reference by proportion.
+def kinetics_axis(rows):
+    positions = np.arange(rows) * len(reference_spectra) / rows
+    reference_rows = np.arange(len(reference_spectra))
+    start, end = spectral.column_range(reference_width)
+    # The ISP averages neighbouring pixels, so the reference is compared as a mean pixel value
+    levels = np.sum(reference_spectra, axis=1) / (end - start)
+    correction = None
+    if reference_correction is not None:
+        # Frames get the correction the reference had, the offset scaled from column sums to mean pixels
+        gain, offset = reference_correction
+        correction = tuple(np.stack([np.interp(positions, reference_rows, values[:, c]) for c in range(3)], axis=1)
+                           for values in (gain, offset / (end - start)))
+    return calibration_for(len(reference_spectra), 'isp')(positions), np.interp(positions, reference_rows, levels), correction
+
+# Switch the camera to `config`, called with camera_lock held. When the configuration is
+# rejected the previous one is restored and started, so the camera is never left stopped.
+def reconfigure(config):
+    previous = picam2.camera_configuration()
+    picam2.stop()
+    try:
+        picam2.configure(config)
+    except Exception:
+        logging.exception("Camera configuration failed, restoring the previous one")
+        picam2.configure(previous)
+        raise
+    finally:
+        picam2.start()
+        picam2.set_controls(camera_controls)
+
+# Pixel counts for the ISP output must be even and at least 2, anything else is a bad request
+def even_size_arg(name, default):
+    value = request.args.get(name, default, type=int)
+    if value is None or value < 2 or value % 2:
+        abort(400, f'{name} must be an even number of at least 2')
+    return value
+
+# Routes that reconfigure the camera or analyse full frames refuse while kinetics mode holds it.
+# Called with camera_lock held, so kinetics cannot start in between.
+def require_no_kinetics():
+    if kinetics_on:
+        abort(409, 'Kinetics mode is on, stop it first')
+
+# Leave kinetics mode for whatever the live view used before, raw and HDR settings included.
+# Called with camera_lock held.
+def end_kinetics():
+    global kinetics_on
+    kinetics_on = False
+    picam2.stop()
+    picam2.configure(preview_config)
+    picam2.start()
+    picam2.set_controls(camera_controls)
+
+# Capture one slit-cropped frame and record its band absorbance, timestamped by the sensor
+def record_kinetics_frame():
+    with camera_lock:
+        if not kinetics_on:
+            return  # Stopped meanwhile
+        recorder = kinetics_recorder
+        frame, metadata = buffers.capture_frame(picam2, frame_buffers, 'kinetics', with_metadata=True)
+    recorder.add(metadata['SensorTimestamp'] / 1e9 + kinetics_clock, frame)
 
 # Function to toggle zoom and adjust the zoom window
 def toggle_zoom():
@@ -114,33 +366,167 @@ def move_zoom_right():
         zoom_window_start = min(total_spectra_length - zoom_window_size, zoom_window_start + 10)
     logging.info(f"Moved right to {zoom_window_start}")
 
-# button1.when_pressed = capture_full_res_image
-# button2.when_pressed = capture_reference_spectra
-button1.when_pressed = move_zoom_right
-button2.when_pressed = toggle_zoom
+# Runs on the live loop, which owns the main display: entering the waterfall sends it whole once
+def toggle_waterfall(enable=None):
+    global waterfall_mode
+    waterfall_mode = not waterfall_mode if enable is None else enable
+    if waterfall_mode:
+        disp_main.ShowArray(spectrum_waterfall.buffer)
+        disp_main.ShowRows(WATERFALL_CURSOR, spectrum_waterfall.head)
+    logging.info(f"Main display: {'waterfall' if waterfall_mode else 'camera'}")
+    return waterfall_mode
+
+# Send the newest waterfall row and the cursor below it, two one-row windows instead of a full frame
+def display_waterfall_row(row):
+    disp_main.ShowRows(spectrum_waterfall.buffer[row:row + 1], row)
+    disp_main.ShowRows(WATERFALL_CURSOR, spectrum_waterfall.head)
+
+# Initialize buttons
+def init_buttons():
+    global button1, button2, button3
+    button1 = Button(KEY1_PIN)
+    button2 = Button(KEY2_PIN)
+    button3 = Button(KEY3_PIN)
+    button3.when_pressed = lambda: loop_commands.post(toggle_waterfall)
+    # button1.when_pressed = capture_full_res_image
+    # button2.when_pressed = capture_reference_spectra
+    button1.when_pressed = move_zoom_right
+    button2.when_pressed = toggle_zoom
+
+# Reset, clear and light up one display
+def init_display(disp):
+    disp.Init()
+    disp.clear()
+    disp.bl_DutyCycle(100)
+    disp.bl_Frequency(1000)
+    return disp
+
+# Initialize the main display
+def init_main_display():
+    global disp_main
+    disp_main = init_display(ST7789.ST7789(spi=SPI.SpiDev(1, 0), spi_freq=10000000, rst=27, dc=22, bl=19))
+
+# Initialize the side displays, they share SPI bus 0 so they go one after the other
+def init_side_displays():
+    global disp_side1, disp_side2
+    disp_side1 = init_display(LCD_side.LCD_side(spi=SPI.SpiDev(0, 1), spi_freq=10000000, rst=23, dc=5, bl=12))
+    disp_side2 = init_display(LCD_side.LCD_side(spi=SPI.SpiDev(0, 0), spi_freq=10000000, rst=24, dc=4, bl=13))
+
+def init_camera():
+    global picam2, preview_config
+    # Imported here so the slow libcamera import overlaps with display bring-up
+    from picamera2 import Picamera2
+    picam2 = Picamera2()
+    preview_config = picam2.create_still_configuration(main={"size": (1920, 1080)})  # Use full display height for the camera
+    picam2.configure(preview_config)
+    picam2.start()
+
+    # Fix camera settings
+    picam2.set_controls(camera_controls)
+
+# Bring up the displays on both SPI buses and the camera at the same time
+def start_hardware():
+    startup_timer.parallel({
+        'main display': init_main_display,
+        'side displays': init_side_displays,
+        'camera': init_camera,
+    })
+    startup_timer.step('buttons', init_buttons)
+
+# Camera frame as an image with red lines marking the columns used for the spectrum
+def camera_view(frame):
+    camera_img = Image.fromarray(frame)
+    draw = ImageDraw.Draw(camera_img)
+    draw.line([(frame.shape[1] // 3, 0), (frame.shape[1] // 3, frame.shape[0])], fill="red")
+    draw.line([(2 * frame.shape[1] // 3, 0), (2 * frame.shape[1] // 3, frame.shape[0])], fill="red")
+    return camera_img
 
 # Flask setup
 app = Flask(__name__)
 
+# Live MJPEG streams, each frame is encoded once and shared by all viewers
+camera_stream = stream.FrameBroadcaster(lambda frame: stream.mjpeg_part(camera_view(frame)))
+plot_stream = stream.FrameBroadcaster()
+# The waterfall is only unrolled into time order when someone is watching
+waterfall_stream = stream.FrameBroadcaster(lambda w: stream.mjpeg_part(w.image()))
+
+# Raw spectrum streams (Server-Sent Events) for client-side plotting
+spectrum_stream = stream.FrameBroadcaster(lambda item: stream.spectrum_event(*item), max_queued=4)
+spectrum_rgb_stream = stream.FrameBroadcaster(lambda item: stream.spectrum_event(*item, channels=True), max_queued=4)
+
 @app.route('/')
 def index():
     return render_template_string("""
     <!doctype html>
     <title>Spectra Plot and Camera View</title>
     <h1>Spectra Plot</h1>
-    <img id="plot" src="/plot.png" alt="Spectra Plot">
+    <img id="plot" src="/plot.mjpg" alt="Spectra Plot">
     <h1>Camera View</h1>
-    <img id="camera" src="/camera.png" alt="Camera View">
+    <img id="camera" src="/camera.mjpg" alt="Camera View">
     <br>
     <a href="/fullres">Capture Full-Resolution Image</a>
+    <a href="/live">Live Spectrum</a>
+    <a href="/waterfall">Waterfall</a>
+    """)
+
+@app.route('/waterfall')
+def waterfall_page():
+    return render_template_string("""
+    <!doctype html>
+    <title>Waterfall</title>
+    <h1>Waterfall</h1>
+    <img id="waterfall" src="/waterfall.mjpg" alt="Waterfall">
+    <br>
+    <a href="/">Back to Main Page</a>
+    """)
+
+@app.route('/live')
+def live():
+    return render_template_string("""
+    <!doctype html>
+    <title>Live Spectrum</title>
+    <h1>Live Spectrum</h1>
+    <canvas id="spectrum" width="800" height="300" style="border:1px solid #ccc"></canvas>
+    <div id="info"></div>
+    <br>
+    <a href="/">Back to Main Page</a>
     <script>
-        function refreshImage(id, url) {
-            document.getElementById(id).src = url + '?t=' + new Date().getTime();
+        function unpack(b64, Type) {
+            const bytes = Uint8Array.from(atob(b64), c => c.charCodeAt(0));
+            return new Type(bytes.buffer);
         }
-        setInterval(() => {
-            refreshImage('plot', '/plot.png');
-            refreshImage('camera', '/camera.png');
-        }, 1000);
+        const canvas = document.getElementById('spectrum');
+        const ctx = canvas.getContext('2d');
+        let wavelengths = null;
+        const source = new EventSource('/spectrum/stream?channels=1');
+        source.addEventListener('axis', e => {
+            wavelengths = unpack(JSON.parse(e.data).wavelengths, Float32Array);
+        });
+        source.addEventListener('spectrum', e => {
+            const msg = JSON.parse(e.data);
+            const combined = unpack(msg.combined, Uint16Array);
+            const rgb = msg.rgb ? unpack(msg.rgb, Uint16Array) : null;
+            const w = canvas.width, h = canvas.height, n = combined.length;
+            ctx.clearRect(0, 0, w, h);
+            const traces = [[combined, 1, 0, '#000']];
+            if (rgb) {
+                traces.push([rgb, 3, 0, '#d00'], [rgb, 3, 1, '#0a0'], [rgb, 3, 2, '#00d']);
+            }
+            for (const [data, stride, offset, color] of traces) {
+                ctx.strokeStyle = color;
+                ctx.beginPath();
+                for (let i = 0; i < n; i++) {
+                    const x = i * (w - 1) / (n - 1);
+                    const y = h - 1 - data[i * stride + offset] * (h - 1) / 65535;
+                    i ? ctx.lineTo(x, y) : ctx.moveTo(x, y);
+                }
+                ctx.stroke();
+            }
+            if (wavelengths && wavelengths.length === n) {
+                document.getElementById('info').textContent =
+                    wavelengths[0].toFixed(1) + ' nm - ' + wavelengths[n - 1].toFixed(1) + ' nm';
+            }
+        });
     </script>
     """)
 
@@ -150,18 +536,33 @@ def fullres():
     <!doctype html>
     <title>Full Resolution Image</title>
     <h1>Full Resolution Image</h1>
-    <img id="fullres" src="/fullres_image.png" alt="Full Resolution Image">
+    <div id="status">Starting capture...</div>
+    <img id="fullres" alt="Full Resolution Image">
+    <img id="fullres_plot" alt="Full Resolution Spectra">
     <h1>Camera View</h1>
-    <img id="camera" src="/camera.png" alt="Camera View">
+    <img id="camera" src="/camera.mjpg" alt="Camera View">
     <br>
     <a href="/">Back to Main Page</a>
     <script>
-        function refreshImage(id, url) {
-            document.getElementById(id).src = url + '?t=' + new Date().getTime();
+        async function capture() {
+            const job = await (await fetch('/fullres/jobs', {method: 'POST'})).json();
+            const status = document.getElementById('status');
+            while (true) {
+                const state = await (await fetch('/fullres/jobs/' + job.id)).json();
+                status.textContent = 'Capture ' + state.status;
+                if (state.status === 'done') {
+                    document.getElementById('fullres').src = '/fullres/jobs/' + job.id + '/image.png';
+                    document.getElementById('fullres_plot').src = '/fullres/jobs/' + job.id + '/plot.png';
+                    break;
+                }
+                if (state.status === 'failed') {
+                    status.textContent = 'Capture failed: ' + state.error;
+                    break;
+                }
+                await new Promise(resolve => setTimeout(resolve, 500));
+            }
         }
-        setInterval(() => {
-            refreshImage('camera', '/camera.png');
-        }, 1000);
+        capture();
     </script>
     """)
 
@@ -169,7 +570,7 @@ def fullres():
 def plot_png():
     global current_plot
     img_io = io.BytesIO()
-    current_plot.save(img_io, 'PNG')
+    Image.fromarray(current_plot).save(img_io, 'PNG')
     img_io.seek(0)
     return send_file(img_io, mimetype='image/png')
 
@@ -177,41 +578,490 @@ def plot_png():
 def camera_png():
     global current_camera_image
     img_io = io.BytesIO()
-    current_camera_image.save(img_io, 'PNG')
+    camera_view(current_camera_image).save(img_io, 'PNG')
     img_io.seek(0)
     return send_file(img_io, mimetype='image/png')
 
+@app.route('/camera.mjpg')
+def camera_mjpg():
+    return Response(camera_stream.stream(), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/plot.mjpg')
+def plot_mjpg():
+    return Response(plot_stream.stream(), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/waterfall.mjpg')
+def waterfall_mjpg():
+    return Response(waterfall_stream.stream(), mimetype='multipart/x-mixed-replace; boundary=frame')
+
+@app.route('/waterfall/display', methods=['GET', 'POST'])
+def waterfall_display_route():
+    # POST ?on=1 shows the waterfall on the main display, ?on=0 goes back to the camera
+    if request.method == 'POST':
+        loop_commands.post(toggle_waterfall, request.args.get('on', '1') == '1').result(timeout=5)
+    return jsonify({'on': waterfall_mode})
+
+@app.route('/spectrum/stream')
+def spectrum_sse():
+    broadcaster = spectrum_rgb_stream if request.args.get('channels') else spectrum_stream
+    initial = None
+    if spectrum_length:
+        initial = stream.axis_event(calibration_for(spectrum_length)(np.arange(spectrum_length)))
+    return Response(broadcaster.stream(initial), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+@app.route('/history')
+def history_route():
+    store = history_store  # The live loop swaps stores when the spectrum length changes
+    if store is None:
+        abort(503)  # No frames recorded yet
+    start = request.args.get('from', -np.inf, type=float)
+    end = request.args.get('to', np.inf, type=float)
+    limit = max(1, min(request.args.get('limit', HISTORY_MAX_ROWS, type=int), HISTORY_MAX_ROWS))
+    decimate = request.args.get('decimate', type=int)
+    if decimate is None:
+        # Without an explicit step the whole range comes back thinned out to fit the limit
+        decimate = -(-store.count_range(start, end) // limit)
+    timestamps, spectra = store.query(start, end, decimate, limit)
+    # With an explicit step the rows past the limit are paged: `next` is the `from` of the following page
+    following = None
+    if len(timestamps) == limit:
+        after = float(np.nextafter(timestamps[-1], np.inf))
+        if store.count_range(after, end):
+            following = after
+    wavelengths = calibration_for(store.length)(np.arange(store.length))
+    if request.args.get('format') == 'npz':
+        headers = {'Content-Disposition': 'attachment; filename=history.npz'}
+        if following is not None:
+            headers['X-History-Next'] = repr(following)
+        return Response(stream.npz_stream({'wavelengths': wavelengths, 'timestamps': timestamps, 'spectra': spectra}),
+                        mimetype='application/octet-stream', headers=headers)
+    return jsonify({
+        'wavelengths': wavelengths.tolist(),
+        'timestamps': timestamps.tolist(),
+        'spectra': spectra.tolist(),
+        'decimate': max(1, decimate),
+        'next': following,
+    })
+
+@app.route('/hdr', methods=['GET', 'POST'])
+def hdr_route():
+    global hdr_mode, hdr_exposures
+    if request.method == 'POST':
+        if request.args.get('exposures'):
+            hdr_exposures = sorted(int(e) for e in request.args['exposures'].split(','))
+        enable = request.args.get('on', '1') == '1'
+        if hdr_mode and not enable:
+            # Back to the fixed single exposure
+            with camera_lock:
+                picam2.set_controls(camera_controls)
+        hdr_mode = enable
+        hdr_pipeline.reset()
+        logging.info(f"HDR mode {'on' if hdr_mode else 'off'}, exposures {hdr_exposures}")
+    return jsonify({'on': hdr_mode, 'exposures': hdr_exposures})
+
+@app.route('/exposure', methods=['GET', 'POST'])
+def exposure_route():
+    global auto_exposure
+    if request.method == 'POST':
+        if 'auto' in request.args:
+            auto_exposure = request.args['auto'] == '1'
+        manual = {}
+        if 'exposure' in request.args:
+            manual["ExposureTime"] = request.args.get('exposure', type=int)
+        if 'gain' in request.args:
+            manual["AnalogueGain"] = request.args.get('gain', type=float)
+        if manual:
+            auto_exposure = False
+            camera_controls.update(manual)
+            with camera_lock:
+                picam2.set_controls(manual)
+    return jsonify({
+        'auto': auto_exposure,
+        'exposure': camera_controls["ExposureTime"],
+        'gain': camera_controls["AnalogueGain"],
+    })
+
+# Configure the camera for raw mode with camera_lock held and return the configuration. The packed
+# sensor format moves the least data, only the slit columns are unpacked per frame. The main stream
+# then only feeds the previews, so it is kept small.
+def configure_raw():
+    def configuration(raw_format):
+        return picam2.create_still_configuration(
+            main={"size": RAW_MAIN_SIZE}, raw={"format": raw_format, "size": picam2.sensor_resolution})
+
+    config = configuration(picam2.sensor_format)
+    reconfigure(config)
+    try:
+        raw.parse_format(picam2.camera_configuration()['raw']['format'])
+        return config
+    except ValueError:
+        pass
+    # Some ISPs keep packed frames compressed in memory, plain 16-bit pixels can still be read
+    try:
+        config = configuration(raw.unpacked_format(picam2.sensor_format))
+        reconfigure(config)
+        raw.parse_format(picam2.camera_configuration()['raw']['format'])
+    except Exception as e:
+        reconfigure(preview_config)
+        abort(501, f"Raw stream not supported: {e}")
+    return config
+
+@app.route('/raw', methods=['GET', 'POST'])
+def raw_route():
+    global raw_mode, raw_stream_config, preview_config
+    if request.method == 'POST':
+        enable = request.args.get('on', '1') == '1'
+        if enable != raw_mode:
+            with camera_lock:
+                require_no_kinetics()
+                if enable:
+                    config = configure_raw()
+                else:
+                    config = picam2.create_still_configuration(main={"size": (1920, 1080)})
+                    reconfigure(config)
+                preview_config = config
+                raw_stream_config = picam2.camera_configuration()['raw'] if enable else None
+                raw_mode = enable
+                clear_reference()  # Raw spectra have the raw stream's length
+                hdr_pipeline.reset()  # A merge from the other stream has the wrong length
+            if raw_mode and 'raw' not in calibrations:
+                logging.warning("No raw calibration yet, wavelengths are approximate until /calibrate is run")
+            logging.info(f"Raw mode {'on' if raw_mode else 'off'}")
+    return jsonify({'on': raw_mode, 'format': raw_stream_config['format'] if raw_mode else None})
+
+@app.route('/modes', methods=['GET', 'POST'])
+def modes_route():
+    global capture_mode, preview_config, raw_mode, raw_stream_config
+    exposure_time = camera_controls["ExposureTime"]
+    if request.method == 'POST':
+        still = request.args.get('mode') == 'still'
+        if not still:
+            spectral_pixels = even_size_arg('spectral', 1080)
+            spatial_width = even_size_arg('spatial', 240)
+        with camera_lock:
+            require_no_kinetics()
+            if still:
+                config, report = picam2.create_still_configuration(main={"size": (1920, 1080)}), None
+            else:
+                mode = modes.select_mode(picam2.sensor_modes, spectral_pixels)
+                config, report = modes.mode_configuration(picam2, mode, spectral_pixels, spatial_width, exposure_time)
+            reconfigure(config)
+            preview_config, capture_mode = config, report
+            # The high-rate configurations carry no raw stream
+            raw_mode, raw_stream_config = False, None
+            clear_reference()
+        logging.info(f"Capture mode: {capture_mode or 'still'}")
+    return jsonify({
+        'current': capture_mode,
+        'sensor_modes': [
+            {'size': list(m['size']), 'bit_depth': m['bit_depth'], 'fps': m['fps'],
+             'achievable_fps': round(modes.achievable_fps(m, exposure_time), 1)}
+            for m in picam2.sensor_modes
+        ],
+    })
+
+@app.route('/correction', methods=['GET', 'POST'])
+def correction_route():
+    global correction_on
+    if request.method == 'POST':
+        correction_on = request.args.get('on', '1') == '1'
+    calibration = correction_store.get(camera_controls["ExposureTime"], camera_controls["AnalogueGain"])
+    return jsonify({
+        'on': correction_on,
+        'dark': calibration is not None and calibration.dark is not None,
+        'flat': calibration is not None and calibration.gain is not None,
+        'settings': [{'exposure': e, 'gain': g} for e, g in correction_store.settings()],
+    })
+
+@app.route('/correction/<kind>', methods=['POST'])
+def capture_correction(kind):
+    # Dark with the light blocked, then flat with an even broadband source, at the current exposure and gain
+    if kind not in ('dark', 'flat'):
+        abort(404)
+    count = request.args.get('frames', 16, type=int)
+    exposure_time, gain = camera_controls["ExposureTime"], camera_controls["AnalogueGain"]
+    with camera_lock:
+        require_no_kinetics()
+        average = correction.average_spectra(picam2.capture_array, process_frame, count)
+    if kind == 'dark':
+        correction_store.set_dark(exposure_time, gain, average)
+    else:
+        correction_store.set_flat(exposure_time, gain, average)
+    logging.info(f"Captured {kind} correction from {count} frames at {exposure_time} us, gain {gain}")
+    return jsonify({'kind': kind, 'frames': count, 'exposure': exposure_time, 'gain': gain})
+
+@app.route('/reference', methods=['POST'])
+def reference_route():
+    rows = capture_reference_spectra(request.args.get('frames', REFERENCE_FRAMES, type=int)).result(timeout=5)
+    if rows is None:
+        abort(409, 'No spectra yet')
+    return jsonify({'rows': rows})
+
+@app.route('/kinetics')
+def kinetics_route():
+    if kinetics_recorder is None:
+        return jsonify({'on': False})
+    return jsonify({'on': kinetics_on, 'mode': kinetics_mode, **kinetics_recorder.summary()})
+
+@app.route('/kinetics/start', methods=['POST'])
+def start_kinetics():
+    global kinetics_on, kinetics_recorder, kinetics_mode, kinetics_clock
+    if reference_spectra is None:
+        abort(409, 'Capture a reference first')
+    try:
+        bands = kinetics.parse_bands(request.args.get('bands', KINETICS_BANDS))
+    except ValueError:
+        abort(400, 'bands must look like 480:10,520:10')
+    recorder = kinetics.KineticsRecorder(bands, capacity=KINETICS_CAPACITY)
+    spectral_pixels = even_size_arg('spectral', 1080)
+    spatial_width = even_size_arg('spatial', 32)
+    with camera_lock:
+        if kinetics_on:
+            end_kinetics()  # Restarting, crop from the preview again rather than the slit crop
+        # Keep only the slit columns of the area the preview sees
+        crop = modes.slit_crop(picam2.capture_metadata()['ScalerCrop'])
+        mode = modes.select_mode(picam2.sensor_modes, spectral_pixels)
+        config, report = modes.mode_configuration(
+            picam2, mode, spectral_pixels, spatial_width, camera_controls["ExposureTime"], crop=crop)
+        reconfigure(config)
+        try:
+            recorder.configure(*kinetics_axis(picam2.camera_configuration()['main']['size'][1]))
+        except Exception:
+            reconfigure(preview_config)  # Not recording, so the live view gets the camera back
+            raise
+        kinetics_mode = report
+        kinetics_clock = time.time() - time.monotonic()  # Sensor timestamps count on the monotonic clock
+        kinetics_recorder = recorder
+        kinetics_on = True
+    logging.info(f"Kinetics mode on: {kinetics_mode}, bands {recorder.bands}")
+    return jsonify({'on': True, 'mode': kinetics_mode, 'bands': recorder.bands})
+
+@app.route('/kinetics/stop', methods=['POST'])
+def stop_kinetics():
+    with camera_lock:
+        if kinetics_on:
+            end_kinetics()
+    logging.info("Kinetics mode off")
+    return jsonify({'on': False})
+
+@app.route('/kinetics/data')
+def kinetics_data():
+    if kinetics_recorder is None:
+        abort(404)
+    timestamps, values = kinetics_recorder.query(request.args.get('from', -np.inf, type=float),
+                                                 request.args.get('to', np.inf, type=float))
+    if request.args.get('format') == 'npz':
+        img_io = io.BytesIO()
+        np.savez_compressed(img_io, bands=np.array(kinetics_recorder.bands), timestamps=timestamps, absorbance=values)
+        img_io.seek(0)
+        return send_file(img_io, mimetype='application/octet-stream', download_name='kinetics.npz')
+    return jsonify({
+        'bands': kinetics_recorder.bands,
+        'timestamps': timestamps.tolist(),
+        # A band without reference light has no absorbance
+        'absorbance': [[float(v) if np.isfinite(v) else None for v in row] for row in values],
+    })
+
+@app.route('/smoothing', methods=['GET', 'POST'])
+def smoothing_route():
+    global smoothing
+    if request.method == 'POST':
+        settings = {'kind': request.args.get('kind', smoothing['kind'])}
+        for key, cast in (('window', int), ('order', int), ('deriv', int), ('sigma', float)):
+            if key in request.args:
+                settings[key] = request.args.get(key, type=cast)
+            elif key in smoothing:
+                settings[key] = smoothing[key]
+        try:
+            # Reject bad parameters before the live loop sees them, with the same call the loop makes
+            filters.smooth(np.zeros((64, 3)), axis=0, out=np.empty((64, 3)), **settings)
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        smoothing = settings
+    return jsonify(smoothing)
+
+@app.route('/peaks')
+def peaks_route():
+    return jsonify([track.to_dict() for track in peak_tracker.visible()])
+
+@app.route('/library/match')
+def library_match_route():
+    k = request.args.get('k', 5, type=int)
+    return jsonify([{'name': name, 'score': score} for name, score in library_matches[:k]])
+
+@app.route('/library/reload', methods=['POST'])
+def library_reload_route():
+    global library_generation
+    spectral_library.reload()
+    library_generation += 1
+    return jsonify({'spectra': len(spectral_library.names)})
+
+@app.route('/calibrate', methods=['POST'])
+def calibrate_route():
+    # Point the spectrometer at a fluorescent lamp first, a few frames are averaged to beat the noise
+    count = request.args.get('frames', 5, type=int)
+    with camera_lock:
+        require_no_kinetics()
+        source = 'raw' if raw_mode else 'isp'
+        if raw_mode:
+            # Fit on the linear raw spectra the live loop shows, their rows differ from the ISP output
+            pool = buffers.BufferPool()  # The live loop's pool is not shared across threads
+            spectra = np.stack([raw.capture_with_raw(picam2, pool, 'frame', *raw_geometry())[1][0]
+                                for _ in range(count)])
+        else:
+            spectra, _ = spectral.process_frames(np.stack([picam2.capture_array() for _ in range(count)]))
+    combined_spectra = filters.smooth(np.sum(spectra, axis=2).mean(axis=0), **smoothing)
+    polynomial, report = calibrate.calibrate_from_spectrum(combined_spectra)
+    if polynomial is None:
+        logging.warning(f"Calibration failed: {report.get('error')}")
+        return jsonify(report), 422
+    calibrate.save_calibration(CALIBRATION_PATHS[source], polynomial, report, len(combined_spectra))
+    calibrations[source] = (polynomial, len(combined_spectra))
+    report['source'] = source
+    logging.info(f"Calibrated on {len(report['matched'])} lines, RMS {report['rms']:.3f} nm")
+    return jsonify(report)
+
+@app.route('/color')
+def color_route():
+    if color_measurement is None:
+        abort(503)  # No light, or no frame yet
+    return jsonify(color_measurement)
+
+@app.route('/exports')
+def list_exports():
+    sessions = []
+    if os.path.isdir(EXPORT_DIR):
+        for name in sorted(os.listdir(EXPORT_DIR)):
+            index_path = os.path.join(EXPORT_DIR, name, export.INDEX_NAME)
+            if os.path.exists(index_path):
+                with open(index_path) as f:
+                    chunks = json.load(f)['chunks']
+                sessions.append({'name': name, 'chunks': len(chunks), 'spectra': sum(c['count'] for c in chunks)})
+    return jsonify({'active': export_session is not None, 'sessions': sessions})
+
+@app.route('/exports/start', methods=['POST'])
+def start_export():
+    global export_session, export_frames
+    with export_lock:
+        if export_session is None:
+            name = datetime.now().strftime('%Y%m%d-%H%M%S')
+            export_frames = request.args.get('frames') == '1'
+            # Frames are about 6 MB each, so they go out one per chunk with little queued. The live
+            # loop must not wait on the SD card, rows are dropped and counted while the writer is behind.
+            export_session = export.SpectrumExporter(os.path.join(EXPORT_DIR, name), export_metadata(),
+                                                     chunk_size=1 if export_frames else 256,
+                                                     max_queued=2 if export_frames else 4,
+                                                     pool=offload_pool, drop=True)
+            logging.info(f"Export started: {name}")
+        name = os.path.basename(export_session.directory)
+    return jsonify({'name': name, 'frames': export_frames})
+
+@app.route('/exports/stop', methods=['POST'])
+def stop_export():
+    global export_session
+    with export_lock:
+        session, export_session = export_session, None
+    if session is None:
+        abort(409)  # Nothing to stop
+    session.close()
+    return jsonify({'name': os.path.basename(session.directory), 'dropped': session.dropped})
+
+@app.route('/exports/<name>.tar')
+def download_export(name):
+    # Only serve directories that really are exports, never arbitrary paths
+    if not os.path.isdir(EXPORT_DIR) or name not in os.listdir(EXPORT_DIR):
+        abort(404)
+    return Response(export.stream_tar(os.path.join(EXPORT_DIR, name)), mimetype='application/x-tar',
+                    headers={'Content-Disposition': f'attachment; filename={name}.tar'})
+
+@app.route('/fullres/jobs', methods=['POST'])
+def create_full_res_job():
+    require_no_kinetics()
+    job = full_res_jobs.submit()
+    return jsonify(job.to_dict()), 202
+
+def lookup_job(job_id, require_done=True):
+    job = full_res_jobs.get(job_id)
+    if job is None:
+        abort(404)
+    if require_done and job.status != 'done':
+        abort(409)  # Result not ready yet
+    return job
+
+@app.route('/fullres/jobs/<job_id>')
+def full_res_job_status(job_id):
+    return jsonify(lookup_job(job_id, require_done=False).to_dict())
+
+@app.route('/fullres/jobs/<job_id>/image.png')
+def full_res_job_image(job_id):
+    img_io = io.BytesIO()
+    lookup_job(job_id).result['image'].save(img_io, 'PNG')
+    img_io.seek(0)
+    return send_file(img_io, mimetype='image/png')
+
+@app.route('/fullres/jobs/<job_id>/plot.png')
+def full_res_job_plot(job_id):
+    img_io = io.BytesIO()
+    lookup_job(job_id).result['plot'].save(img_io, 'PNG')
+    img_io.seek(0)
+    return send_file(img_io, mimetype='image/png')
+
+@app.route('/fullres/jobs/<job_id>/spectrum.json')
+def full_res_job_spectrum(job_id):
+    result = lookup_job(job_id).result
+    spectra = result['spectra']
+    return jsonify({
+        'timestamp': result['timestamp'],
+        'wavelengths': calibration_for(len(spectra), 'isp')(np.arange(len(spectra))).tolist(),
+        'spectra': spectra.tolist(),
+        'light_color': result['light_color'].tolist(),
+    })
+
 @app.route('/fullres_image.png')
 def capture_full_res_image_route():
-    capture_full_res_image()
+    # Kept for old links: waits for a queued capture instead of touching the camera itself
+    require_no_kinetics()
+    job = full_res_jobs.submit()
+    job.done.wait()
+    if job.status != 'done':
+        abort(500)
     img_io = io.BytesIO()
-    full_res_image = Image.open("full_res.jpg")
-    full_res_image.save(img_io, 'PNG')
+    job.result['image'].save(img_io, 'PNG')
     img_io.seek(0)
     return send_file(img_io, mimetype='image/png')
 
+@app.route('/diagnostics/allocations', methods=['GET', 'POST'])
+def allocation_check_route():
+    # POST arms the check for the next frames, GET reads the report once they have run
+    if request.method == 'POST':
+        allocation_check.start(request.args.get('frames', 20, type=int))
+    return jsonify(allocation_check.report)
+
 def start_flask():
     app.run(host='0.0.0.0', port=5000)
 
-# Function to process the image and extract the spectra using the middle third of the image
-def process_frame(frame):
-    height, width, _ = frame.shape
-    start_col = width // 3
-    end_col = 2 * width // 3
-    middle_frame = frame[:, start_col:end_col]
-
-    # Sum the pixel values along the horizontal axis to get the combined spectra
-    spectra = np.sum(middle_frame, axis=1)
-    light_color = np.max(middle_frame, axis=1)
-    return spectra, light_color
-
-# Function to find peaks in the spectra using NumPy
-def find_peaks_in_spectra(spectra, distance=10, threshold=0.1):
-    peaks = []
-    for i in range(distance, len(spectra) - distance):
-        if spectra[i] > threshold and spectra[i] == max(spectra[i - distance:i + distance + 1]):
-            peaks.append(i)
-    return np.array(peaks)
+# History ring for `length`-point spectra, pruning the least recently used files of other lengths
+def open_history(length):
+    path = HISTORY_PATH.format(length=length)
+    capacity = min(HISTORY_CAPACITY, HISTORY_FILE_BYTES // (8 + 4 * length))  # float64 time, float32 values
+    store = history.HistoryStore(path, length, capacity=capacity)
+    # Layout changes leave .old files behind, they count as files too
+    others = [p for p in glob.glob(HISTORY_PATH.format(length='*') + '*') if p != path]
+    others.sort(key=os.path.getmtime, reverse=True)
+    for stale in others[HISTORY_FILES - 1:]:
+        os.remove(stale)
+        logging.info(f"Removed history file {stale} to stay within {HISTORY_FILES} files")
+    return store
+
+# Function to process the image and extract the spectra using the middle third of the image.
+# With a buffer pool the results go into its reused arrays.
+def process_frame(frame, pool=None):
+    out = None
+    if pool is not None:
+        height = frame.shape[0]
+        out = (pool.get('spectra', (height, 3), np.uint64), pool.get('light_color', (height, 3), frame.dtype))
+    return spectral.process_frames(frame, out=out)
 
 # Function to normalize color brightness
 def normalize_color(r, g, b):
@@ -221,121 +1071,252 @@ def normalize_color(r, g, b):
     scale = 255 / max_val
     return int(r * scale), int(g * scale), int(b * scale)
 
-# Function to plot the spectra
-def plot_spectra(spectra, light_color, reference_spectra=None, width=240, height=240):
-    spectra_img = Image.new('RGB', (width, height), 'white')
-    draw = ImageDraw.Draw(spectra_img)
-
-    # Normalize the spectra to fit the height of the image
-    combined_spectra = np.sum(spectra, axis=1)  # Sum across all three channels
-    max_intensity = np.max(combined_spectra)
-    normalized_spectra = (combined_spectra / max_intensity * (height - 1)).astype(int)
-
-    # If zoomed, only plot the zoom window
+# Visible part of the spectrum as (start, count), only the zoom window when zoomed
+def plot_window():
     if zoomed:
-        start = zoom_window_start
-        end = zoom_window_start + zoom_window_size
-        zoomed_spectra = normalized_spectra[start:end]
-        for x, intensity in enumerate(zoomed_spectra):
-            r, g, b = light_color[start + x]
-            r, g, b = normalize_color(r, g, b)
-            draw.line([(x, 0), (x, intensity)], fill=(r, g, b))  # Vertical bar
-    else:
-        # Plot the entire spectra if not zoomed
-        for x, intensity in enumerate(normalized_spectra):
-            r, g, b = light_color[x]
-            r, g, b = normalize_color(r, g, b)
-            draw.line([(x, 0), (x, intensity)], fill=(r, g, b))  # Vertical bar
+        return zoom_window_start, zoom_window_size
+    return 0, None
 
-    # If reference spectra is provided, plot the transmission
-    if reference_spectra is not None:
-        combined_reference_spectra = np.sum(reference_spectra, axis=1)
-        with np.errstate(divide='ignore', invalid='ignore'):
-            transmission = np.where(combined_reference_spectra > 0, (combined_spectra / combined_reference_spectra) * 100, 0)
-        max_transmission = np.max(transmission[np.isfinite(transmission)])
-        if max_transmission > 0:
-            normalized_transmission = (transmission / max_transmission * (height - 1)).astype(int)
-            for x, intensity in enumerate(normalized_transmission):
-                if np.isfinite(intensity) and intensity >= 0:
-                    draw.line([(x, 0), (x, intensity)], fill='blue')
-    return spectra_img
-
-# Function to display image on LCD
+# Function to plot the spectra onto the cached axes and gridlines
+def plot_spectra(spectra, light_color, reference_spectra=None, width=240, height=240, out=None):
+    start, count = plot_window()
+    return plotting.render_plot(spectra, light_color, calibration_for(len(spectra)), reference_spectra,
+                                width=width, height=height, start=start, count=count, out=out)
+
+# Function to display an image on LCD, RGB arrays of the display size are sent as they are
 def display_on_lcd(image, disp):
+    if isinstance(image, np.ndarray):
+        if image.shape[:2] == (disp.height, disp.width):
+            disp.ShowArray(image)
+            return
+        image = Image.fromarray(image)
     img = image.resize((disp.width, disp.height))
     disp.ShowImage(img)
 
+# Text panel behind the peaks display, glyphs are cached and only changed lines are redrawn
+peaks_panel = None
+
 # Function to display the wavelengths of the peaks
-def display_peaks(peaks, spectra, disp):
-    peaks_img = Image.new('RGB', (disp.width, disp.height), 'white')
-    draw = ImageDraw.Draw(peaks_img)
-    font = ImageFont.load_default()
+def display_peaks(tracks, disp, footer=()):
+    global peaks_panel
+    if peaks_panel is None:
+        peaks_panel = text_panel.TextPanel(disp.width, disp.height)
+
+    # Leave the bottom lines free for the footer
+    lines = [None] * len(peaks_panel.lines)
+    max_lines = len(lines) - len(footer)
+    for i, track in enumerate(tracks[:min(10, max_lines)]):
+        color = normalize_color(*track.color)  # Use the color of the spectra at the peak
+        lines[i] = (f"Peak {track.id}: {track.wavelength:.1f} nm", color)
+    for i, text in enumerate(footer):
+        lines[max_lines + i] = (text, (0, 0, 0))
 
-    # Create a list of the wavelength values and their corresponding colors
-    wavelengths = calibration_polynomial(peaks)  # Use the calibration polynomial to convert pixel positions to wavelengths
+    for y0, y1 in peaks_panel.set_lines(lines):
+        # The panel is mounted upside down, so each band is sent rotated by 180 degrees
+        disp.ShowRows(peaks_panel.canvas[y0:y1][::-1, ::-1], disp.height - y1)
 
-    for i, peak in enumerate(peaks[:10]):
-        wavelength = wavelengths[i]
-        r, g, b = spectra[peak]  # Color at the peak
-        r, g, b = normalize_color(r, g, b)
-        text = f"Peak {i + 1}: {wavelength:.2f} nm"
-        draw.text((5, i * 10), text, font=font, fill=(r, g, b))  # Use the color of the spectra
+# Latest absorbance and trend of every kinetics band on the side panel
+def display_kinetics(disp):
+    global peaks_panel
+    if peaks_panel is None:
+        peaks_panel = text_panel.TextPanel(disp.width, disp.height)
+    summary = kinetics_recorder.summary()
+    lines = [None] * len(peaks_panel.lines)
+    lines[0] = ("Kinetics", (0, 0, 0))
+    for i, band in enumerate(summary['bands'][:len(lines) - 2]):
+        if band.get('absorbance') is None:
+            text = f"{band['centre']:.0f}nm A --"
+        else:
+            text = f"{band['centre']:.0f}nm A {band['absorbance']:.3f} {band['rate'] or 0:+.4f}/s"
+        lines[i + 1] = (text, (0, 0, 0))
+    lines[-1] = (f"{summary.get('rate_hz', 0):.0f} Hz, {summary['samples']} samples", (0, 0, 0))
 
-    display_on_lcd(peaks_img.rotate(180), disp)  # Rotate the image by 180 degrees to correct the orientation
+    for y0, y1 in peaks_panel.set_lines(lines):
+        disp.ShowRows(peaks_panel.canvas[y0:y1][::-1, ::-1], disp.height - y1)
 
 
 # Main function
 def main():
     global reference_spectra
+    global spectra_calibration
     global picam2
     global current_plot
     global current_camera_image
-    picam2 = Picamera2()
-    config = picam2.create_still_configuration(main={"size": (1920, 1080)})  # Use full display height for the camera
-    picam2.configure(config)
-    picam2.start()
+    global spectrum_length
+    global history_store
+    global capture_archive
+    global library_matches
+    global color_measurement
+    global hdr_pipeline
+    global offload_pool
+    # Fork the workers while this is still the only thread
+    offload_pool = startup_timer.step('offload pool', lambda: offload.OffloadPool(OFFLOAD_WORKERS))
+    start_hardware()
 
-    # Fix camera settings
-    picam2.set_controls({
-        "ExposureTime": 20000,        # Set the exposure time in microseconds
-        "AnalogueGain": 1.0,          # Set the analogue gain
-        "AwbEnable": False,           # Disable automatic white balance
-        "AeEnable": False,            # Disable automatic exposure
-#        "AfMode": controls.AfModeEnum.Manual,           # Set autofocus mode to manual
-#        "LensPosition": 0.5           # Set the lens position for manual focus
-    })
+    capture_archive = export.SpectrumExporter(os.path.join(EXPORT_DIR, 'captures'), export_metadata(),
+                                              chunk_size=1, pool=offload_pool)
+    # ISP frames are merged after inverting the tuning gamma, the exposures only add up in linear light
+    linear = functools.partial(hdr.process_linear, table=hdr.linear_table(hdr.tuning_gamma_curve(picam2)))
+    hdr_pipeline = hdr.HdrPipeline(linear, pool=offload_pool)
 
     # Start Flask in a separate thread
     flask_thread = threading.Thread(target=start_flask)
     flask_thread.daemon = True
     flask_thread.start()
 
+    panel_footer = None  # Footer lines currently shown on the peaks panel
+    library_search = None  # Library ranking running in a worker
+    first_frame = True
+    parity = 0  # Which of the two frame and plot buffers this iteration fills
+    kinetics_panel_time = 0.0  # When the kinetics summary was last drawn
     while True:
         try:
+            allocation_check.frame()
             start = time.time()
-            frame = picam2.capture_array()
-            camera_img = Image.fromarray(frame)
-            
-            # Draw red lines to indicate the area being used
-            draw = ImageDraw.Draw(camera_img)
-            draw.line([(frame.shape[1] // 3, 0), (frame.shape[1] // 3, frame.shape[0])], fill="red")
-            draw.line([(2 * frame.shape[1] // 3, 0), (2 * frame.shape[1] // 3, frame.shape[0])], fill="red")
+            loop_commands.run_pending()
+            if kinetics_on:
+                # Nothing but capture and the band values, no preview, plot or delay
+                record_kinetics_frame()
+                if start - kinetics_panel_time >= KINETICS_PANEL_INTERVAL:
+                    display_kinetics(disp_side2)
+                    kinetics_panel_time = start
+                    panel_footer = None  # Redraw the peaks once kinetics mode ends
+                continue
 
-            current_camera_image = camera_img  # Save the current camera image to be served by Flask
+            if hdr_mode and raw_mode:
+                # Raw spectra are linear already and small, each bracket set is merged right away
+                with camera_lock:
+                    bracket, exposures = hdr.capture_bracket(picam2, hdr_exposures, extract=raw_bracket_frame)
+                frames, bracket_spectra, bracket_colors = zip(*bracket)
+                hdr_pipeline.merge(bracket_spectra, bracket_colors, exposures)
+                frame = frames[len(frames) // 2]
+            elif hdr_mode:
+                # Capture the next bracket set while the previous one is merged in the background
+                with camera_lock:
+                    frames, exposures = hdr.capture_bracket(picam2, hdr_exposures)
+                hdr_pipeline.submit(frames, exposures)
+                frame = frames[len(frames) // 2]
+            elif raw_mode:
+                with camera_lock:
+                    frame, raw_result = raw.capture_with_raw(picam2, frame_buffers, ('frame', parity), *raw_geometry())
+            else:
+                with camera_lock:
+                    frame = buffers.capture_frame(picam2, frame_buffers, ('frame', parity))
 
-            # Display camera image on main display
-            display_on_lcd(camera_img.rotate(90), disp_main)
+            current_camera_image = frame  # Save the current camera frame to be served by Flask
+            camera_stream.publish(frame)
+
+            # Display camera image on main display, rotated and sampled down in one pass,
+            # with red lines to indicate the area being used
+            if not waterfall_mode:
+                preview = frame_buffers.get('preview', (disp_main.height, disp_main.width, 3))
+                buffers.draw_preview(frame, preview, rotate=90, marks=(frame.shape[1] // 3, 2 * frame.shape[1] // 3))
+                disp_main.ShowArray(preview)
             
             # Process frame and plot spectra
-            spectra, light_color = process_frame(frame)
-            spectra_img = plot_spectra(spectra, light_color, reference_spectra, width=160, height=80)
+            spectra_calibration = None
+            if hdr_mode and hdr_pipeline.latest is not None:
+                spectra, light_color = hdr_pipeline.latest  # Merged from the most recent bracket set
+            else:
+                if raw_mode:
+                    spectra, light_color = raw_result
+                else:
+                    spectra, light_color = process_frame(frame, frame_buffers)
+                    if correction_on:
+                        calibration = correction_store.get(camera_controls["ExposureTime"],
+                                                           camera_controls["AnalogueGain"])
+                        if calibration is not None:
+                            corrected = calibration.apply(
+                                spectra, out=frame_buffers.get('corrected', spectra.shape, np.float64))
+                            if corrected is not None:
+                                spectra = corrected
+                                spectra_calibration = calibration
+
+                # Steer exposure from the spectrum we just computed
+                if auto_exposure:
+                    update = exposure_controller.update(light_color, camera_controls["ExposureTime"],
+                                                        camera_controls["AnalogueGain"])
+                    if update is not None:
+                        camera_controls["ExposureTime"], camera_controls["AnalogueGain"] = update
+                        with camera_lock:
+                            picam2.set_controls({"ExposureTime": update[0], "AnalogueGain": update[1]})
+                        logging.info(f"Auto exposure: {update[0]} us, gain {update[1]}")
+
+            recent_spectra.add(spectra)
+
+            # Smooth once for both the plot and the peak search, raw spectra are kept for recording
+            smoothed_spectra = filters.smooth(spectra, axis=0, out=frame_buffers.get('smoothed', spectra.shape, np.float64),
+                                              **smoothing)
+            spectra_img = plot_spectra(smoothed_spectra, light_color, reference_spectra, width=160, height=80,
+                                       out=frame_buffers.get(('plot', parity), (80, 160, 3)))
             current_plot = spectra_img  # Save the current plot to be served by Flask
+            plot_stream.publish(spectra_img)
+            spectrum_length = len(spectra)
+            frame_time = time.time()
+            spectrum_stream.publish((frame_time, spectra))
+            spectrum_rgb_stream.publish((frame_time, spectra))
+
+            # Keep every spectrum in the on-disk history ring
+            if history_store is None or history_store.length != len(spectra):
+                if history_store is not None:
+                    history_store.close()
+                history_store = open_history(len(spectra))
+            history_store.append(frame_time, np.sum(spectra, axis=1))
+
+            with export_lock:
+                if export_session is not None:
+                    # Copied, the pooled arrays are overwritten by the next frame
+                    export_session.add(frame_time, spectra, frame if export_frames else None, copy=True,
+                                       **camera_settings())
             display_on_lcd(spectra_img, disp_side1)
 
             # Find peaks in the spectra
-            peaks = find_peaks_in_spectra(np.sum(spectra, axis=1), distance=10)
-            display_peaks(peaks, light_color, disp_side2)  # Display up to 10 peaks
-        
+            combined_spectra = np.sum(smoothed_spectra, axis=1)
+            peaks = spectral.find_peaks(combined_spectra, distance=10)
+            # Use the calibration polynomial to convert pixel positions to wavelengths
+            wavelength_axis = calibration_for(len(combined_spectra))(np.arange(len(combined_spectra)))
+            changes = peak_tracker.update(wavelength_axis[peaks], combined_spectra[peaks], light_color[peaks])
+
+            # One new waterfall row per frame, kept up to date in camera mode too
+            waterfall_row = spectrum_waterfall.add(combined_spectra)
+            waterfall_stream.publish(spectrum_waterfall)
+            if waterfall_mode:
+                display_waterfall_row(waterfall_row)
+
+            # Rank the frame against the reference library in a worker, the matches arrive a frame or so later
+            if library_search is not None and library_search.done():
+                try:
+                    library_matches = library_search.result()
+                except Exception:
+                    logging.exception("Library search failed")
+                library_search = None
+            if library_search is None:
+                library_search = offload_pool.submit(library.search, LIBRARY_DIR, wavelength_axis, combined_spectra,
+                                                     generation=library_generation)
+
+            # Colorimetry of the calibrated spectrum
+            colorimeter.ensure(wavelength_axis)
+            color_measurement = colorimeter.measure(combined_spectra)
+
+            # Rounded so the panel only redraws when a reading visibly changes
+            footer = []
+            if color_measurement is not None:
+                footer.append(f"CCT {round(color_measurement['cct'], -1):.0f}K Duv {color_measurement['duv']:+.3f}")
+            if library_matches:
+                footer.append(library_matches[0][0])
+
+            if changes or footer != panel_footer:
+                display_peaks(peak_tracker.visible(), disp_side2, footer)  # Only redraw when something changed
+                panel_footer = footer
+
+            if first_frame:
+                startup_timer.mark('first spectrum')
+                startup_timer.report()
+                # Everything allocated so far lives for the whole run, keep it out of GC passes
+                gc.freeze()
+                first_frame = False
+            parity ^= 1
+
             logging.info(f'Frame processing time: {time.time() - start}')
             time.sleep(0.1)  # Short delay between frames
 
@@ -343,6 +1324,12 @@ def main():
             logging.info("Exiting the loop.")
             break
 
+    if history_store is not None:
+        history_store.close()
+    if export_session is not None:
+        export_session.close()
+    capture_archive.close()
+    offload_pool.shutdown()
     picam2.stop()
 
 if __name__ == '__main__':
@@ -10,6 +10,7 @@ from flask import Flask, send_file, render_template_string
 import threading
 import io
 import spidev as SPI
+import spectral
 from datetime import datetime
 from libcamera import controls
 
@@ -77,7 +78,7 @@ def capture_full_res_image():
 
     # Process the full-resolution image
     full_res_image = Image.open(f"full_res_{timestamp}.jpg")
-    spectra, light_color = process_frame(np.array(full_res_image))
+    spectra, light_color = spectral.process_frames(np.array(full_res_image))
     spectra_img = plot_spectra(spectra, light_color, reference_spectra, width=640, height=480)  # Larger plot size
     spectra_img.save(f"full_res_plot_{timestamp}.png")
 
@@ -87,7 +88,7 @@ def capture_reference_spectra():
     global reference_spectra
     global picam2
     frame = picam2.capture_array()
-    reference_spectra, _ = process_frame(frame)
+    reference_spectra, _ = spectral.process_frames(frame)
     logging.info("Reference spectra captured")
 
 zoom = True
@@ -189,26 +190,6 @@ def capture_full_res_image_route():
 def start_flask():
     app.run(host='0.0.0.0', port=5000)
 
-# Function to process the image and extract the spectra using the middle third of the image
-def process_frame(frame):
-    height, width, _ = frame.shape
-    start_col = width // 3
-    end_col = 2 * width // 3
-    middle_frame = frame[:, start_col:end_col]
-
-    # Sum the pixel values along the horizontal axis to get the combined spectra
-    spectra = np.sum(middle_frame, axis=1)
-    light_color = np.max(middle_frame, axis=1)
-    return spectra, light_color
-
-# Function to find peaks in the spectra using NumPy
-def find_peaks_in_spectra(spectra, distance=10, threshold=0.1):
-    peaks = []
-    for i in range(distance, len(spectra) - distance):
-        if spectra[i] > threshold and spectra[i] == max(spectra[i - distance:i + distance + 1]):
-            peaks.append(i)
-    return np.array(peaks)
-
 # Function to normalize color brightness
 def normalize_color(r, g, b):
     max_val = max(r, g, b)
@@ -235,9 +216,8 @@ def plot_spectra(spectra, light_color, reference_spectra=None, width=240, height
     # If reference spectra is provided, plot the transmission
     if reference_spectra is not None:
         combined_reference_spectra = np.sum(reference_spectra, axis=1)
-        with np.errstate(divide='ignore', invalid='ignore'):
-            transmission = np.where(combined_reference_spectra > 0, (combined_spectra / combined_reference_spectra) * 100, 0)
-        max_transmission = np.max(transmission[np.isfinite(transmission)])
+        transmission = spectral.transmission(combined_spectra, combined_reference_spectra)
+        max_transmission = np.max(transmission)
         if max_transmission > 0:
             normalized_transmission = (transmission / max_transmission * (height - 1)).astype(int)
             for x, intensity in enumerate(normalized_transmission):
@@ -313,13 +293,13 @@ def main():
             display_on_lcd(camera_img.resize((160,160)).rotate(90), disp_main)
             
             # Process frame and plot spectra
-            spectra, light_color = process_frame(frame)
+            spectra, light_color = spectral.process_frames(frame)
             spectra_img = plot_spectra(spectra, light_color, reference_spectra, width=160, height=80)
             current_plot = spectra_img  # Save the current plot to be served by Flask
             display_on_lcd(spectra_img, disp_side1)
 
             # Find peaks in the spectra
-            peaks = find_peaks_in_spectra(np.sum(spectra, axis=1), distance=10)
+            peaks = spectral.find_peaks(np.sum(spectra, axis=1), distance=10)
             display_peaks(peaks, light_color, disp_side2)  # Display up to 10 peaks
         
             logging.info(f'Frame processing time: {time.time() - start}')
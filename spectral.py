@@ -0,0 +1,61 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def column_range(width, columns='middle'):
+    """Columns summed into the spectrum: 'middle' third, 'full' width or an explicit (start, end)."""
+    if columns == 'middle':
+        return width // 3, 2 * width // 3
+    if columns == 'full':
+        return 0, width
+    return columns
+
+
+def process_frames(frames, columns='middle', out=None):
+    """Spectra and light colour of one (H, W, 3) frame or a (..., H, W, 3) stack.
+
+    Pixels are summed across the slit columns, giving (..., H, 3) spectra,
+    and their per-row maximum gives light_color. A whole burst or recorded
+    session is one vectorized call. `out` is an optional (spectra,
+    light_color) pair of arrays to write into.
+    """
+    frames = np.asarray(frames)
+    start, end = column_range(frames.shape[-2], columns)
+    region = frames[..., start:end, :]
+    spectra_out, color_out = out if out is not None else (None, None)
+    spectra = np.sum(region, axis=-2, out=spectra_out)
+    light_color = np.max(region, axis=-2, out=color_out)
+    return spectra, light_color
+
+
+def peak_mask(spectra, distance=10, threshold=0.1):
+    """Local maxima of (..., N) spectra as a boolean mask of the same shape.
+
+    A point is a peak when it is above `threshold` and the largest value
+    within `distance` points on either side. The outer `distance` points
+    never are.
+    """
+    spectra = np.asarray(spectra)
+    mask = np.zeros(spectra.shape, dtype=bool)
+    if spectra.shape[-1] <= 2 * distance:
+        return mask
+    window_max = sliding_window_view(spectra, 2 * distance + 1, axis=-1).max(axis=-1)
+    centre = spectra[..., distance:spectra.shape[-1] - distance]
+    mask[..., distance:spectra.shape[-1] - distance] = (centre > threshold) & (centre == window_max)
+    return mask
+
+
+# Peak positions of a single spectrum
+def find_peaks(spectrum, distance=10, threshold=0.1):
+    return np.flatnonzero(peak_mask(spectrum, distance, threshold))
+
+
+def transmission(combined, reference):
+    """Transmission in percent of (..., N) combined spectra against a reference.
+
+    Points where the reference is zero, or the ratio is not finite, read 0.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = np.where(reference > 0, np.asarray(combined) / reference * 100, 0)
+    result[~np.isfinite(result)] = 0
+    return result
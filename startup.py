@@ -0,0 +1,54 @@
+import logging
+import threading
+import time
+
+
+# Seconds since the board powered on, or None where the clock is not available
+def seconds_since_boot():
+    if hasattr(time, 'CLOCK_BOOTTIME'):
+        return time.clock_gettime(time.CLOCK_BOOTTIME)
+    return None
+
+
+class Startup:
+    """Run hardware bring-up steps, concurrently where possible, and time them."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.timings = []  # (name, start offset, duration) in seconds
+
+    def step(self, name, fn):
+        begin = time.monotonic()
+        try:
+            return fn()
+        finally:
+            self.timings.append((name, begin - self.started, time.monotonic() - begin))
+
+    def parallel(self, steps):
+        """Run {name: fn} on one thread each, wait for all, re-raise the first failure."""
+        errors = []
+
+        def run(name, fn):
+            try:
+                self.step(name, fn)
+            except Exception as e:
+                logging.exception(f"Startup step '{name}' failed")
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=item, name=f"startup-{item[0]}") for item in steps.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def mark(self, name):
+        self.timings.append((name, time.monotonic() - self.started, 0.0))
+
+    def report(self):
+        lines = [f"  {name:<16} at {offset:6.3f}s took {duration:6.3f}s" for name, offset, duration in self.timings]
+        boot = seconds_since_boot()
+        if boot is not None:
+            lines.append(f"  {boot:.1f}s since power-on")
+        logging.info("Startup timing:\n" + "\n".join(lines))
@@ -0,0 +1,154 @@
+import base64
+import io
+import json
+import queue
+import threading
+import zipfile
+
+import numpy as np
+from PIL import Image
+
+
+# Encode a PIL image or RGB array as one part of a multipart/x-mixed-replace (MJPEG) stream
+def mjpeg_part(image, quality=80):
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    img_io = io.BytesIO()
+    image.convert('RGB').save(img_io, 'JPEG', quality=quality)
+    data = img_io.getvalue()
+    header = b'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(data)
+    return header + data + b'\r\n'
+
+
+# Format one Server-Sent Events message
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n".encode()
+
+# Pack an array as base64 of its little-endian bytes
+def _pack(values, dtype):
+    return base64.b64encode(np.ascontiguousarray(values, dtype=dtype).tobytes()).decode('ascii')
+
+# Wavelength axis, sent once when a client connects
+def axis_event(wavelengths):
+    return sse_event('axis', {
+        'length': len(wavelengths),
+        'dtype': 'float32',
+        'wavelengths': _pack(wavelengths, '<f4'),
+    })
+
+# One processed spectrum, quantized to uint16 with a shared scale factor.
+# spectra is the (N, 3) per-channel output of process_frame.
+def spectrum_event(timestamp, spectra, channels=False):
+    combined = np.sum(spectra, axis=1)
+    peak = float(np.max(combined))
+    scale = peak / 65535 if peak > 0 else 1.0
+    payload = {
+        't': timestamp,
+        'length': len(combined),
+        'dtype': 'uint16',
+        'scale': scale,
+        'combined': _pack(np.rint(combined / scale), '<u2'),
+    }
+    if channels:
+        payload['rgb'] = _pack(np.rint(spectra / scale), '<u2')
+    return sse_event('spectrum', payload)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only, unseekable file that hands out what was written so far."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def npz_stream(arrays, rows=64):
+    """Generator of an uncompressed .npz archive of 1-D or larger `arrays`, a few rows at a time.
+
+    np.load reads it like any other npz. Only `rows` rows of an array are
+    serialized at once, so the response never holds the whole archive.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w') as archive:
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            with archive.open(name + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array_header_2_0(f, np.lib.format.header_data_from_array_1_0(array))
+                for i in range(0, len(array), rows):
+                    f.write(np.ascontiguousarray(array[i:i + rows]).tobytes())
+                    yield sink.drain()
+    yield sink.drain()
+
+
+class FrameBroadcaster:
+    """Encode each published frame once and fan it out to every connected client.
+
+    Every client gets its own small queue. When a client falls behind, its
+    oldest queued frame is dropped so slow viewers never stall the live loop
+    or the other viewers.
+    """
+
+    def __init__(self, encode=mjpeg_part, max_queued=2):
+        self.encode = encode
+        self.max_queued = max_queued
+        self.latest = None
+        self._clients = set()
+        self._lock = threading.Lock()
+
+    @property
+    def client_count(self):
+        return len(self._clients)
+
+    def publish(self, frame):
+        # Skip the encode entirely while nobody is watching
+        if not self._clients:
+            self.latest = None
+            return
+        data = self.encode(frame)
+        self.latest = data
+        with self._lock:
+            clients = list(self._clients)
+        for q in clients:
+            try:
+                q.put_nowait(data)
+            except queue.Full:
+                # Drop the oldest frame for this slow client and keep the newest
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    q.put_nowait(data)
+                except queue.Full:
+                    pass
+
+    def stream(self, initial=None, timeout=5.0):
+        """Generator yielding encoded frames for one client until it disconnects."""
+        q = queue.Queue(maxsize=self.max_queued)
+        with self._lock:
+            self._clients.add(q)
+        try:
+            if initial is not None:
+                yield initial
+            if self.latest is not None:
+                yield self.latest
+            while True:
+                try:
+                    yield q.get(timeout=timeout)
+                except queue.Empty:
+                    # Nothing published for a while, keep waiting
+                    continue
+        finally:
+            with self._lock:
+                self._clients.discard(q)
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+import buffers
+import filters
+import plotting
+import spectral
+import waterfall
+
+HEIGHT, WIDTH = 1080, 1920  # Still configuration of the live loop
+CALIBRATION = np.poly1d([1e-5, 0.25, 400.0])
+
+
+# Run `step` over synthetic frames under AllocationCheck, as the live loop does
+def measure(step, frames=10, warmup=3):
+    rng = np.random.default_rng(0)
+    source = rng.integers(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8)
+    pool = buffers.BufferPool()
+    check = buffers.AllocationCheck()
+    check.start(frames=frames, warmup=warmup)
+    parity = 0
+    while check.report['status'] != 'done':
+        check.frame()
+        frame = pool.get(('frame', parity), source.shape)
+        np.copyto(frame, source)  # What capture_frame does with the mapped request
+        step(frame, pool, parity)
+        parity ^= 1
+    return check.report
+
+
+def live_frame(frame, pool, parity, reference=None):
+    out = (pool.get('spectra', (HEIGHT, 3), np.uint64), pool.get('light_color', (HEIGHT, 3)))
+    spectra, light_color = spectral.process_frames(frame, out=out)
+    smoothed = filters.smooth(spectra, axis=0, out=pool.get('smoothed', spectra.shape, np.float64))
+    plotting.render_plot(smoothed, light_color, CALIBRATION, reference, width=160, height=80,
+                         out=pool.get(('plot', parity), (80, 160, 3)))
+    preview = pool.get('preview', (240, 240, 3))
+    buffers.draw_preview(frame, preview, rotate=90, marks=(WIDTH // 3, 2 * WIDTH // 3))
+    return smoothed
+
+
+def test_live_loop_allocates_no_frame_sized_buffers():
+    report = measure(live_frame)
+    assert report['ok'], report
+
+
+def test_live_loop_with_reference_and_waterfall():
+    reference = np.full((HEIGHT, 3), 1000.0)
+    spectrum_waterfall = waterfall.Waterfall(240, 240)
+
+    def step(frame, pool, parity):
+        smoothed = live_frame(frame, pool, parity, reference)
+        spectrum_waterfall.add(np.sum(smoothed, axis=1))
+
+    report = measure(step)
+    assert report['ok'], report
+
+
+def test_rgb565_conversion_reuses_its_buffer():
+    config = pytest.importorskip('config')  # Needs spidev and gpiozero
+    disp = config.RaspberryPi.__new__(config.RaspberryPi)  # Only the conversion buffers, no SPI or GPIO
+    disp._rgb565 = np.empty(0, dtype=np.uint8)
+    disp._rgb565_scratch = np.empty(0, dtype=np.uint8)
+    preview = np.zeros((240, 240, 3), dtype=np.uint8)
+    report = measure(lambda frame, pool, parity: disp.to_rgb565(buffers.draw_preview(frame, preview, rotate=90)))
+    assert report['ok'], report
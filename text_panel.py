@@ -0,0 +1,90 @@
+import string
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+
+class GlyphAtlas:
+    """Glyph bitmaps rendered once, so text can be blitted with array slicing.
+
+    Each character becomes a float coverage mask one line high and one
+    advance wide. Characters outside the charset are rendered on first use.
+    """
+
+    def __init__(self, font=None, line_height=10, charset=string.printable):
+        self.font = font or ImageFont.load_default()
+        self.line_height = line_height
+        self.glyphs = {}
+        for ch in charset:
+            if ch.isprintable():
+                self.glyph(ch)
+
+    def glyph(self, ch):
+        mask = self.glyphs.get(ch)
+        if mask is None:
+            try:
+                advance = int(round(self.font.getlength(ch)))
+            except AttributeError:
+                advance = self.font.getsize(ch)[0]  # Older Pillow
+            img = Image.new('L', (max(advance, 1), self.line_height), 0)
+            ImageDraw.Draw(img).text((0, 0), ch, font=self.font, fill=255)
+            mask = np.asarray(img, dtype=np.float32) / 255
+            self.glyphs[ch] = mask
+        return mask
+
+
+class TextPanel:
+    """A fixed grid of text lines kept in an RGB array.
+
+    set_lines() re-renders only the lines whose text or colour changed and
+    returns the row ranges that need to go to the display.
+    """
+
+    def __init__(self, width, height, line_height=10, margin=5, background=(255, 255, 255), atlas=None):
+        self.width = width
+        self.height = height
+        self.line_height = line_height
+        self.margin = margin
+        self.background = np.array(background, dtype=np.float32)
+        self.atlas = atlas or GlyphAtlas(line_height=line_height)
+        self.canvas = np.empty((height, width, 3), dtype=np.uint8)
+        self.canvas[:] = background
+        self.lines = [None] * (height // line_height)
+        self._coverage = np.zeros((line_height, width), dtype=np.float32)
+
+    def _render(self, row, text, color):
+        coverage = self._coverage
+        coverage[:] = 0
+        x = self.margin
+        for ch in text:
+            mask = self.atlas.glyph(ch)
+            w = min(mask.shape[1], self.width - x)
+            if w <= 0:
+                break
+            coverage[:, x:x + w] = np.maximum(coverage[:, x:x + w], mask[:, :w])
+            x += mask.shape[1]
+        y = row * self.line_height
+        band = self.background + coverage[..., None] * (np.array(color, dtype=np.float32) - self.background)
+        self.canvas[y:y + self.line_height] = band.astype(np.uint8)
+
+    def set_lines(self, lines):
+        """Set every line to a (text, color) pair or None, return the changed (y0, y1) bands."""
+        dirty = []
+        for row in range(len(self.lines)):
+            line = lines[row] if row < len(lines) else None
+            if line is not None:
+                line = (line[0], tuple(int(c) for c in line[1]))
+            if line == self.lines[row]:
+                continue
+            self.lines[row] = line
+            if line is None:
+                self._render(row, '', (0, 0, 0))
+            else:
+                self._render(row, *line)
+            y = row * self.line_height
+            # Merge touching bands so each one is a single SPI window
+            if dirty and dirty[-1][1] == y:
+                dirty[-1] = (dirty[-1][0], y + self.line_height)
+            else:
+                dirty.append((y, y + self.line_height))
+        return dirty
@@ -0,0 +1,100 @@
+import itertools
+
+import numpy as np
+
+
+class Track:
+    """One spectral line followed across frames."""
+
+    def __init__(self, track_id, wavelength, intensity, color):
+        self.id = track_id
+        self.wavelength = wavelength
+        self.intensity = intensity
+        self.color = color
+        self.age = 1  # Frames this line has been seen in
+        self.misses = 0  # Consecutive frames it was missing
+        self.shown = None  # Rounded wavelength last reported as a change
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'wavelength': round(float(self.wavelength), 2),
+            'intensity': float(self.intensity),
+            'age': self.age,
+        }
+
+
+class PeakTracker:
+    """Match each frame's peaks to existing tracks and keep stable IDs.
+
+    A peak joins the nearest track within `tolerance` nm, and the track's
+    wavelength and intensity are smoothed with an exponential moving
+    average. Tracks are dropped after `max_misses` frames without a match.
+    `update` returns only the changes a display needs to redraw: new,
+    moved (by at least `precision` nm) and lost tracks.
+    """
+
+    def __init__(self, tolerance=3.0, alpha=0.3, max_misses=5, min_age=3, precision=0.1):
+        self.tolerance = tolerance
+        self.alpha = alpha
+        self.max_misses = max_misses
+        self.min_age = min_age
+        self.precision = precision
+        self.tracks = []
+        self._ids = itertools.count(1)
+
+    def visible(self):
+        # Tracks seen long enough to trust, in wavelength order
+        return sorted((t for t in self.tracks if t.age >= self.min_age), key=lambda t: t.wavelength)
+
+    def update(self, wavelengths, intensities, colors=None):
+        wavelengths = np.asarray(wavelengths, dtype=np.float64)
+        intensities = np.asarray(intensities, dtype=np.float64)
+        matched_tracks, matched_peaks = set(), set()
+
+        if self.tracks and len(wavelengths):
+            # Greedy assignment, closest pairs first
+            distances = np.abs(np.array([t.wavelength for t in self.tracks])[:, None] - wavelengths[None, :])
+            for flat in np.argsort(distances, axis=None):
+                ti, pi = np.unravel_index(flat, distances.shape)
+                if distances[ti, pi] > self.tolerance:
+                    break
+                if ti in matched_tracks or pi in matched_peaks:
+                    continue
+                matched_tracks.add(ti)
+                matched_peaks.add(pi)
+                track = self.tracks[ti]
+                track.wavelength += self.alpha * (wavelengths[pi] - track.wavelength)
+                track.intensity += self.alpha * (intensities[pi] - track.intensity)
+                if colors is not None:
+                    track.color = colors[pi]
+                track.age += 1
+                track.misses = 0
+
+        changes = []
+        survivors = []
+        for ti, track in enumerate(self.tracks):
+            if ti not in matched_tracks:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    if track.shown is not None:
+                        changes.append(('lost', track))
+                    continue
+            survivors.append(track)
+        self.tracks = survivors
+
+        for pi in range(len(wavelengths)):
+            if pi not in matched_peaks:
+                color = colors[pi] if colors is not None else None
+                self.tracks.append(Track(next(self._ids), wavelengths[pi], intensities[pi], color))
+
+        for track in self.tracks:
+            if track.age < self.min_age:
+                continue
+            shown = round(track.wavelength / self.precision)
+            if track.shown is None:
+                changes.append(('new', track))
+            elif shown != track.shown:
+                changes.append(('moved', track))
+            track.shown = shown
+        return changes
@@ -0,0 +1,62 @@
+import functools
+
+import numpy as np
+
+# Colormap anchors from weak to strong: black through purple, red and orange to pale yellow
+COLORMAP_STOPS = ((0, 0, 0), (50, 10, 110), (180, 40, 90), (245, 125, 20), (255, 250, 190))
+
+
+@functools.lru_cache(maxsize=4)
+def colormap(stops=COLORMAP_STOPS, size=256):
+    """(size, 3) uint8 lookup table interpolated between the colour stops."""
+    stops = np.array(stops, dtype=np.float64)
+    positions = np.linspace(0, 1, len(stops))
+    levels = np.linspace(0, 1, size)
+    table = np.stack([np.interp(levels, positions, stops[:, c]) for c in range(3)], axis=1)
+    return np.rint(table).astype(np.uint8)
+
+
+# Spectrum points shown in each of `width` columns, nearest neighbour
+@functools.lru_cache(maxsize=8)
+def sample_columns(length, width):
+    return np.rint(np.linspace(0, length - 1, width)).astype(np.intp)
+
+
+class Waterfall:
+    """Spectra over time as a colour-coded image, one row per frame.
+
+    The image is a ring: each spectrum overwrites the oldest row and the
+    row index is returned, so a display only needs that one row sent. The
+    colour scale follows the brightest recent level, decaying slowly so
+    flicker and drift stay visible instead of being normalized away.
+    """
+
+    def __init__(self, width=240, rows=240, decay=0.995, stops=COLORMAP_STOPS):
+        self.width = width
+        self.rows = rows
+        self.decay = decay
+        self.lut = colormap(stops)
+        self.buffer = np.zeros((rows, width, 3), dtype=np.uint8)
+        self.head = 0  # Row the next spectrum goes to
+        self.scale = 0.0
+        self._levels = np.empty(width)
+        self._index = np.empty(width, dtype=np.intp)
+
+    def add(self, spectrum):
+        """Colour one combined spectrum into the next row and return that row's index."""
+        # Assigned rather than taken with out=, the spectrum may be integer or float32
+        self._levels[:] = spectrum[sample_columns(len(spectrum), self.width)]
+        self.scale = max(self.scale * self.decay, float(self._levels.max()))
+        if self.scale > 0:
+            self._levels *= (len(self.lut) - 1) / self.scale
+        np.clip(self._levels, 0, len(self.lut) - 1, out=self._levels)
+        np.copyto(self._index, self._levels, casting='unsafe')
+        row = self.head
+        np.take(self.lut, self._index, axis=0, out=self.buffer[row])
+        self.head = (row + 1) % self.rows
+        return row
+
+    def image(self):
+        """Copy of the rows in time order, newest at the top."""
+        order = (self.head - 1 - np.arange(self.rows)) % self.rows
+        return self.buffer[order]